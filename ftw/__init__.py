@@ -1,8 +1,9 @@
 from . import errors
 from . import http
+from . import journal
 from . import logchecker
 from . import ruleset
 from . import testrunner
 from . import util
 
-__all__ = [errors, http, logchecker, ruleset, testrunner, util]
+__all__ = [errors, http, journal, logchecker, ruleset, testrunner, util]
@@ -1,16 +1,17 @@
+from http import cookiejar
 from http import cookies
-from io import BytesIO
+import asyncio
 import base64
+import collections
 import encodings
-import errno
-import gzip
+import functools
 import os
 import re
 import socket
 import ssl
-import sys
+import threading
+import time
 import zlib
-import select
 
 import brotli
 from IPy import IP
@@ -21,80 +22,776 @@ from . import util
 
 SOCKET_TIMEOUT = .3
 
+PUBLIC_SUFFIX_LIST_PATH = os.path.join(os.path.dirname(__file__),
+                                       'util', 'public_suffix_list.dat')
 
-class HttpResponse(object):
-    def __init__(self, http_response, user_agent):
-        self.response = util.ensure_binary(http_response)
-        # For testing purposes HTTPResponse might be called OOL
-        try:
-            self.dest_addr = user_agent.request_object.dest_addr
-        except AttributeError:
-            self.dest_addr = '127.0.0.1'
-        self.response_line = None
-        self.status = None
-        self.cookiejar = user_agent.cookiejar
-        self.status_msg = None
-        self.version = None
-        self.headers = None
-        self.data = None
-        self.CRLF = b'\r\n'
-        self.process_response()
+_public_suffix_list = None
+_public_suffix_list_lock = threading.Lock()
 
-    def parse_content_encoding(self, response_headers, response_data):
+CRLF_BYTES = b'\r\n'
+CHARSET_RE = re.compile(r'\;\s{0,1}?charset\=(.*?)(?:$|\;|\s)')
+SET_COOKIE_RE = re.compile(br'\nset-cookie[ \t]*:', re.IGNORECASE)
+ENCODING_ALIASES = frozenset(encodings.aliases.aliases.keys()) | \
+    frozenset(encodings.aliases.aliases.values())
+
+# Limits applied when removing a Content-Encoding
+MAX_DECODED_SIZE = 64 * 1024 * 1024
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# Cookies kept by an HttpUA before the least recently used are evicted
+MAX_COOKIES = 3000
+
+_ssl_contexts = {}
+_tls_sessions = {}
+_ssl_lock = threading.Lock()
+
+
+class PublicSuffixList(object):
+    """
+    Indexed form of the public suffix list, supporting plain, wildcard
+    ('*.ck') and exception ('!www.ck') rules. Lookups cost O(labels)
+    """
+    def __init__(self, rules=(), wildcards=(), exceptions=()):
+        self.rules = frozenset(rules)
+        self.wildcards = frozenset(wildcards)
+        self.exceptions = frozenset(exceptions)
+
+    @classmethod
+    def from_file(cls, psl_path):
         """
-        Parses a response that contains Content-Encoding to retrieve
-        response_data
+        Parses the public suffix list found at psl_path
         """
-        if response_headers['content-encoding'] == 'br':
-            try:
-                response_data = brotli.decompress(response_data)
-            except brotli.error:
+        rules = set()
+        wildcards = set()
+        exceptions = set()
+        with open(psl_path, 'r', encoding='utf-8') as fo:
+            for line in fo:
+                if line[:2] == '//' or line[0] == ' ' or \
+                   line[0].strip() == '':
+                    continue
+                rule = line.split()[0].lower()
+                if rule.startswith('!'):
+                    exceptions.add(rule[1:])
+                elif rule.startswith('*.'):
+                    wildcards.add(rule[2:])
+                else:
+                    rules.add(rule)
+        return cls(rules, wildcards, exceptions)
+
+    def is_public_suffix(self, domain):
+        """
+        Check if domain is listed as a public suffix
+        """
+        domain = domain.lower()
+        if domain in self.rules:
+            return True
+        if domain in self.exceptions:
+            return False
+        parent = domain.partition('.')[2]
+        return parent != '' and parent in self.wildcards
+
+    def get_registrable_domain(self, domain):
+        """
+        Return the public suffix of domain plus one label. A domain that
+        is itself a public suffix is returned unchanged
+        """
+        labels = domain.lower().split('.')
+        for i in range(1, len(labels)):
+            if self.is_public_suffix('.'.join(labels[i:])):
+                return '.'.join(labels[i - 1:])
+        # Unlisted top level domains are public suffixes too
+        return '.'.join(labels[-2:])
+
+
+def get_public_suffix_list():
+    """
+    Return the process-wide PublicSuffixList, building it on first use
+    """
+    global _public_suffix_list
+    if _public_suffix_list is not None:
+        return _public_suffix_list
+    with _public_suffix_list_lock:
+        if _public_suffix_list is None:
+            # Check if the public suffix list is present in the ftw dir
+            if not os.path.exists(PUBLIC_SUFFIX_LIST_PATH):
                 raise errors.TestError(
-                    'Invalid or missing brotli data found',
+                    'unable to find the needed public suffix list',
                     {
-                        'response_data': str(response_data),
-                        'function': 'http.HttpResponse.parse_content_encoding'
+                        'Search_Dir': os.path.dirname(__file__),
+                        'function': 'http.get_public_suffix_list'
                     })
-        elif response_headers['content-encoding'] == 'gzip':
-            buf = BytesIO(response_data)
-            zipbuf = gzip.GzipFile(fileobj=buf)
             try:
-                response_data = zipbuf.read()
+                _public_suffix_list = PublicSuffixList.from_file(
+                    PUBLIC_SUFFIX_LIST_PATH)
             except IOError:
                 raise errors.TestError(
-                    'Invalid or missing gzip data found',
+                    'unable to open the needed publix suffix list',
                     {
-                        'response_data': str(response_data),
-                        'function': 'http.HttpResponse.parse_content_encoding'
+                        'path': PUBLIC_SUFFIX_LIST_PATH,
+                        'function': 'http.get_public_suffix_list'
                     })
-        elif response_headers['content-encoding'] == 'deflate':
+    return _public_suffix_list
+
+
+StoredCookie = collections.namedtuple(
+    'StoredCookie', ['morsel', 'origin', 'domain', 'host_only', 'expires'])
+
+
+class CookieJar(object):
+    """
+    Cookie store indexed by registrable domain and path, so finding the
+    cookies of a request costs O(matching cookies). Cookies are replaced
+    by name, expire with Max-Age/Expires and the least recently used are
+    evicted past max_cookies
+    """
+    def __init__(self, max_cookies=MAX_COOKIES):
+        self.max_cookies = max_cookies
+        # (domain, path, name) -> StoredCookie, least recently used first
+        self.cookies = collections.OrderedDict()
+        # registrable domain -> path -> (domain, path, name) in the order
+        # the cookies were set
+        self.index = {}
+
+    def __len__(self):
+        return len(self.cookies)
+
+    def __iter__(self):
+        """
+        Yield (SimpleCookie, origin) pairs, the form of the old list jar
+        """
+        for stored in list(self.cookies.values()):
+            cookie = cookies.SimpleCookie()
+            cookie[stored.morsel.key] = stored.morsel
+            yield (cookie, stored.origin)
+
+    def append(self, cookie_origin):
+        """
+        Add a (SimpleCookie, origin) pair, the form of the old list jar
+        """
+        self.add(*cookie_origin)
+
+    def get_site(self, host):
+        """
+        Return the index key of host, its registrable domain
+        """
+        if is_ip_address(host) or '.' not in host:
+            return host.lower()
+        return get_public_suffix_list().get_registrable_domain(host)
+
+    def add(self, cookie, origin):
+        """
+        Store the morsels of a SimpleCookie received from origin
+        """
+        origin = origin.lower()
+        origin_is_ip = is_ip_address(origin)
+        now = time.time()
+        for name, morsel in list(cookie.items()):
+            domain = morsel['domain'].lstrip('.').lower()
+            host_only = domain == '' or origin_is_ip
+            if host_only:
+                domain = origin
+            path = morsel['path'] if morsel['path'].startswith('/') else '/'
+            key = (domain, path, name)
+            expires = self.get_expiry(morsel, now)
+            if key in self.cookies:
+                self.remove(key)
+            # A cookie expiring now is a request to delete it
+            if expires is not None and expires <= now:
+                continue
+            self.cookies[key] = StoredCookie(morsel, origin, domain,
+                                             host_only, expires)
+            paths = self.index.setdefault(self.get_site(domain), {})
+            paths.setdefault(path, {})[key] = None
+        while len(self.cookies) > self.max_cookies:
+            self.remove(next(iter(self.cookies)))
+
+    def get_expiry(self, morsel, now):
+        """
+        Return when morsel expires as a timestamp, None for session cookies
+        """
+        if morsel['max-age'] != '':
             try:
-                response_data = zlib.decompress(response_data, -zlib.MAX_WBITS)
-            except zlib.error:
+                return now + int(morsel['max-age'])
+            except ValueError:
+                pass
+        if morsel['expires'] != '':
+            return cookiejar.http2time(morsel['expires'])
+        return None
+
+    def remove(self, key):
+        """
+        Drop the cookie stored under key
+        """
+        stored = self.cookies.pop(key)
+        site = self.get_site(stored.domain)
+        paths = self.index[site]
+        del paths[key[1]][key]
+        if not paths[key[1]]:
+            del paths[key[1]]
+            if not paths:
+                del self.index[site]
+
+    def get_paths(self, path):
+        """
+        Return the cookie paths that path-match path (RFC 6265 5.1.4)
+        """
+        paths = [path]
+        for i, char in enumerate(path):
+            if char == '/':
+                if i:
+                    paths.append(path[:i])
+                paths.append(path[:i + 1])
+        return paths
+
+    def get_cookies(self, host, path='/'):
+        """
+        Return the morsels to send to host for path, longest path first
+        """
+        host = host.lower()
+        paths = self.index.get(self.get_site(host))
+        if not paths:
+            return []
+        now = time.time()
+        matches = []
+        for cookie_path in sorted(set(self.get_paths(path)), key=len,
+                                  reverse=True):
+            for key in list(paths.get(cookie_path, ())):
+                stored = self.cookies[key]
+                if stored.expires is not None and stored.expires <= now:
+                    self.remove(key)
+                    continue
+                if host != stored.domain and (
+                        stored.host_only or
+                        not host.endswith('.' + stored.domain)):
+                    continue
+                self.cookies.move_to_end(key)
+                matches.append(stored.morsel)
+        return matches
+
+
+def get_ssl_context(ciphers, verify=True):
+    """
+    Return the process-wide SSLContext for a cipher string and verification
+    setting, so the default certificates are only loaded once
+    """
+    key = (ciphers, verify)
+    with _ssl_lock:
+        context = _ssl_contexts.get(key)
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            context.set_ciphers(ciphers)
+            context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+            _ssl_contexts[key] = context
+    return context
+
+
+def get_tls_session(context, dest_addr, port):
+    """
+    Return the last TLS session negotiated with dest_addr:port through
+    context, None if there is none
+    """
+    with _ssl_lock:
+        return _tls_sessions.get((id(context), dest_addr, port))
+
+
+def save_tls_session(context, dest_addr, port, session):
+    """
+    Remember a TLS session so later connections can resume it
+    """
+    with _ssl_lock:
+        _tls_sessions[(id(context), dest_addr, port)] = session
+
+
+def is_idle(sock):
+    """
+    Check that nothing, not even EOF, is waiting to be read on a kept-alive
+    connection. Anything pending would be taken for the response to the
+    next request sent over it
+    """
+    if isinstance(sock, ssl.SSLSocket) and sock.pending():
+        return False
+    timeout = sock.gettimeout()
+    try:
+        sock.settimeout(0)
+        # Peek at the raw socket, SSLSocket.recv does not take flags
+        socket.socket.recv(sock, 1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except OSError:
+            pass
+    return False
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of idle keep-alive connections, keyed by
+    (protocol, dest_addr, port). A single pool may be shared by many
+    HttpUA objects so connections are reused across stages and tests
+    """
+    def __init__(self, max_per_host=4):
+        self.max_per_host = max_per_host
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Take an idle connection for key out of the pool, None if there is
+        no idle connection available. Connections with data or EOF waiting
+        are closed rather than handed out
+        """
+        while True:
+            with self.lock:
+                idle = self.connections.get(key)
+                if not idle:
+                    return None
+                sock = idle.pop()
+            if is_idle(sock):
+                return sock
+            sock.close()
+
+    def put(self, key, sock):
+        """
+        Return a connection to the pool, closing it if the pool for key is
+        already full or if the server sent more than the last response
+        """
+        if not is_idle(sock):
+            sock.close()
+            return
+        with self.lock:
+            idle = self.connections.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append(sock)
+                return
+        sock.close()
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            connections = self.connections
+            self.connections = {}
+        for idle in connections.values():
+            for sock in idle:
+                sock.close()
+
+
+class ResponseReader(object):
+    """
+    Incremental HTTP/1.x response framer. Data is received straight into a
+    growable buffer, the status line and headers are parsed as soon as they
+    are complete and the body is framed by Content-Length, chunked
+    Transfer-Encoding or, if neither is present, by the server closing the
+    connection
+    """
+    CRLF = b'\r\n'
+
+    def __init__(self, method='GET', size=8192):
+        self.method = method
+        self.buffer = bytearray(size)
+        self.length = 0
+        self.status = None
+        self.headers = {}
+        self.body_start = None
+        self.content_length = None
+        self.chunked = False
+        self.chunk_pos = None
+        # complete is set once no more data needs to be read, framed when
+        # that was decided by the message itself rather than by EOF
+        self.complete = False
+        self.framed = False
+
+    def recv_into(self, sock, size):
+        """
+        Receive up to size bytes from sock directly into the buffer,
+        returns the number of bytes received
+        """
+        self.reserve(size)
+        with memoryview(self.buffer) as view:
+            received = sock.recv_into(view[self.length:], size)
+        if received:
+            self.received(received)
+        return received
+
+    def feed(self, data):
+        """
+        Add data read from the connection, returns True once the response
+        is complete
+        """
+        self.reserve(len(data))
+        self.buffer[self.length:self.length + len(data)] = data
+        return self.received(len(data))
+
+    def reserve(self, size):
+        """
+        Make sure there is room for size more bytes, doubling the buffer
+        so growing it stays amortized O(1)
+        """
+        needed = self.length + size
+        if needed > len(self.buffer):
+            self.buffer.extend(bytes(max(needed, 2 * len(self.buffer)) -
+                                     len(self.buffer)))
+
+    def received(self, size):
+        """
+        Account for size bytes written at the end of the buffer
+        """
+        self.length += size
+        if self.body_start is None:
+            self.parse_head()
+        if self.body_start is not None and not self.complete:
+            self.check_body()
+        return self.complete
+
+    def feed_eof(self):
+        """
+        The connection was closed, whatever was read is the response
+        """
+        self.complete = True
+
+    def mark_framed(self):
+        """
+        The message itself says it is complete
+        """
+        self.complete = True
+        self.framed = True
+
+    def getvalue(self):
+        """
+        The response received, as bytes
+        """
+        with memoryview(self.buffer) as view:
+            return bytes(view[:self.length])
+
+    def parse_head(self):
+        """
+        Parse the status line and headers once they have been received
+        """
+        prefix = bytes(self.buffer[:min(self.length, 5)])
+        if prefix != b'HTTP/'[:len(prefix)]:
+            # Not HTTP, there is no way to know where this ends
+            self.complete = True
+            return
+        header_end = self.buffer.find(self.CRLF + self.CRLF, 0, self.length)
+        if header_end == -1:
+            return
+        self.body_start = header_end + 4
+        lines = bytes(self.buffer[:header_end]).split(self.CRLF)
+        try:
+            self.status = int(lines[0].split(b' ', 2)[1])
+        except (IndexError, ValueError):
+            # Let HttpResponse complain about it, read until EOF
+            return
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            self.headers[util.ensure_str(name, errors='replace').lower()] = \
+                util.ensure_str(value, errors='replace').strip()
+        if self.method == 'HEAD' or self.status < 200 or \
+           self.status in (204, 304):
+            self.mark_framed()
+        elif 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self.chunked = True
+            self.chunk_pos = self.body_start
+        elif 'content-length' in self.headers:
+            try:
+                self.content_length = int(self.headers['content-length'])
+            except ValueError:
+                pass
+
+    def check_body(self):
+        """
+        Check if the whole body has been received
+        """
+        if self.chunked:
+            self.check_chunks()
+        elif self.content_length is not None and \
+                self.length - self.body_start >= self.content_length:
+            self.mark_framed()
+
+    def check_chunks(self):
+        """
+        Walk over the chunks received so far
+        """
+        while True:
+            line_end = self.buffer.find(self.CRLF, self.chunk_pos,
+                                        self.length)
+            if line_end == -1:
+                return
+            size = bytes(self.buffer[self.chunk_pos:line_end])
+            try:
+                size = int(size.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                # Malformed chunk, fall back on reading until EOF
+                self.chunked = False
+                return
+            if size == 0:
+                # The last chunk is followed by optional trailers and CRLF
+                if self.buffer.find(self.CRLF, line_end + 2,
+                                    self.length) == line_end + 2:
+                    self.mark_framed()
+                elif self.buffer.find(self.CRLF + self.CRLF, line_end,
+                                      self.length) != -1:
+                    self.mark_framed()
+                return
+            chunk_end = line_end + 2 + size + 2
+            if self.length < chunk_end:
+                return
+            self.chunk_pos = chunk_end
+
+
+def decode_chunked(data, pos=0):
+    """
+    Remove the chunked Transfer-Encoding from the body found at offset pos
+    of data, a body that is not validly chunked is returned unchanged
+    """
+    decoded = []
+    start = pos
+    while True:
+        line_end = data.find(b'\r\n', pos)
+        if line_end == -1:
+            return data[start:]
+        try:
+            size = int(data[pos:line_end].split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            return data[start:]
+        if size == 0:
+            return b''.join(decoded)
+        pos = line_end + 2
+        decoded.append(data[pos:pos + size])
+        pos += size + 2
+
+
+@functools.lru_cache(maxsize=1024)
+def is_ip_address(addr):
+    """
+    Check if addr is an IP address rather than a hostname
+    """
+    try:
+        IP(addr)
+    except ValueError:
+        return False
+    return True
+
+
+class ContentDecoder(object):
+    """
+    Incremental decoder for a single content-coding. Data is fed chunk by
+    chunk and decoded output is produced in pieces of at most chunk_size
+    bytes, so memory stays bounded whatever the compression ratio
+    """
+    def __init__(self, coding, chunk_size=DECODE_CHUNK_SIZE):
+        self.coding = coding
+        self.chunk_size = chunk_size
+        self.started = False
+        if coding == 'br':
+            self.decompressor = brotli.Decompressor()
+            if not hasattr(self.decompressor, 'can_accept_more_data'):
+                # Without an output limit a few bytes could inflate to
+                # gigabytes before the decoded size is checked
                 raise errors.TestError(
-                    'Invalid or missing deflate data found',
+                    'Brotli cannot limit its output, Brotli>=1.2.0 is '
+                    'required to decode br content',
                     {
-                        'response_data': str(response_data),
-                        'function': 'http.HttpResponse.parse_content_encoding'
+                        'brotli_version': getattr(brotli, '__version__',
+                                                  None),
+                        'function': 'http.ContentDecoder.__init__'
                     })
+        elif coding in ('gzip', 'x-gzip'):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif coding == 'deflate':
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif coding == 'identity':
+            self.decompressor = None
         else:
             raise errors.TestError(
                 'Received unknown Content-Encoding',
                 {
-                    'content-encoding':
-                        str(response_headers['content-encoding']),
-                    'function': 'http.HttpResponse.parse_content_encoding'
+                    'content-encoding': str(coding),
+                    'function': 'http.ContentDecoder.__init__'
+                })
+
+    def decode(self, chunks):
+        """
+        Generator decoding an iterable of chunks
+        """
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                self.started = True
+                if self.decompressor is None:
+                    yield chunk
+                elif self.coding == 'br':
+                    yield from self.decode_brotli(chunk)
+                else:
+                    yield from self.decode_zlib(chunk)
+            if self.started and self.coding == 'br':
+                yield from self.flush_brotli()
+            self.finish()
+        except (zlib.error, brotli.error) as err:
+            raise errors.TestError(
+                'Invalid or missing %s data found' % self.coding_name(),
+                {
+                    'msg': str(err),
+                    'function': 'http.ContentDecoder.decode'
                 })
-        return response_data
+
+    def coding_name(self):
+        """
+        Name of the coding used in error messages
+        """
+        return 'brotli' if self.coding == 'br' else self.coding
+
+    def decode_zlib(self, data):
+        """
+        Decode gzip or deflate data in pieces of at most chunk_size
+        """
+        while True:
+            piece = self.decompressor.decompress(data, self.chunk_size)
+            if piece:
+                yield piece
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                if not data or self.coding == 'deflate':
+                    return
+                # gzip allows several members one after the other
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                continue
+            data = self.decompressor.unconsumed_tail
+            if not data and len(piece) < self.chunk_size:
+                return
+
+    def decode_brotli(self, data):
+        """
+        Decode brotli data in pieces of at most chunk_size
+        """
+        yield self.decompressor.process(
+            data, output_buffer_limit=self.chunk_size)
+        while not self.decompressor.can_accept_more_data():
+            yield self.decompressor.process(
+                b'', output_buffer_limit=self.chunk_size)
+
+    def flush_brotli(self):
+        """
+        Drain output brotli held back because of the output limit
+        """
+        while not self.decompressor.is_finished():
+            piece = self.decompressor.process(
+                b'', output_buffer_limit=self.chunk_size)
+            if not piece:
+                return
+            yield piece
+
+    def finish(self):
+        """
+        Check that the encoded data was complete
+        """
+        if not self.started or self.decompressor is None:
+            return
+        if self.coding == 'br':
+            complete = self.decompressor.is_finished()
+        else:
+            complete = self.decompressor.eof
+        if not complete:
+            raise errors.TestError(
+                'Invalid or missing %s data found' % self.coding_name(),
+                {
+                    'msg': 'The encoded data is truncated',
+                    'function': 'http.ContentDecoder.finish'
+                })
+
+
+def decode_content(content_encoding, data, max_size=MAX_DECODED_SIZE,
+                   chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Generator removing the content-codings listed in a Content-Encoding
+    header, e.g. 'gzip, br', from data, a body already fully received. It
+    is fed to the decoders in slices of chunk_size and decoding stops with
+    a TestError as soon as more than max_size decoded bytes have been
+    produced
+    """
+    codings = [coding.strip().lower()
+               for coding in content_encoding.split(',') if coding.strip()]
+    chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    # Codings are listed in the order they were applied
+    for coding in reversed(codings):
+        chunks = ContentDecoder(coding, chunk_size).decode(chunks)
+    decoded_size = 0
+    for chunk in chunks:
+        decoded_size += len(chunk)
+        if max_size is not None and decoded_size > max_size:
+            raise errors.TestError(
+                'Decoded response data exceeds the maximum size',
+                {
+                    'content-encoding': str(content_encoding),
+                    'max_size': max_size,
+                    'function': 'http.decode_content'
+                })
+        yield chunk
+
+
+class HttpResponse(object):
+    """
+    An HTTP response. Only the status line is parsed up front, headers,
+    cookies and the decoded body are parsed the first time they are used
+    """
+    def __init__(self, http_response, user_agent):
+        self.response = util.ensure_binary(http_response)
+        # For testing purposes HTTPResponse might be called OOL
+        try:
+            self.dest_addr = user_agent.request_object.dest_addr
+        except AttributeError:
+            self.dest_addr = '127.0.0.1'
+        self.response_line = None
+        self.status = None
+        self.cookiejar = user_agent.cookiejar
+        self.status_msg = None
+        self.version = None
+        self.CRLF = b'\r\n'
+        self._headers = None
+        self._body = None
+        self._body_start = None
+        self._data = None
+        self._data_decoded = False
+        self._cookie = None
+        self.max_decoded_size = getattr(user_agent, 'MAX_DECODED_SIZE',
+                                        MAX_DECODED_SIZE)
+        self.process_response_line()
+        # Cookies must reach the jar before the next request is built
+        if self.has_set_cookie():
+            cookie = self.cookie
+            if cookie is not None:
+                self.cookiejar.add(cookie, self.dest_addr)
+
+    def parse_content_encoding(self, response_headers, response_data):
+        """
+        Parses a response that contains Content-Encoding to retrieve
+        response_data
+        """
+        return b''.join(self.iter_content_decoded(
+            response_headers['content-encoding'], response_data))
+
+    def iter_content_decoded(self, content_encoding, response_data):
+        """
+        Generator removing content_encoding from response_data
+        incrementally, bounded by max_decoded_size
+        """
+        return decode_content(content_encoding,
+                              response_data if response_data else b'',
+                              self.max_decoded_size)
 
     def check_for_cookie(self, cookie):
         # http://bayou.io/draft/cookie.domain.html
         # Check if our originDomain is an IP
-        origin_is_ip = True
-        try:
-            IP(self.dest_addr)
-        except ValueError:
-            origin_is_ip = False
+        origin_is_ip = is_ip_address(self.dest_addr)
         for cookie_morsals in list(cookie.values()):
             # If the coverdomain is blank or the domain is an IP
             # set the domain to be the origin
@@ -115,33 +812,8 @@ class HttpResponse(object):
                 cover_domain = cover_domain[first_non_dot:]
                 # We must parse the coverDomain to make sure its
                 # not in the suffix list
-                psl_path = os.path.join(os.path.dirname(__file__),
-                                        'util', 'public_suffix_list.dat')
-                # Check if the public suffix list is present in the ftw dir
-                if os.path.exists(psl_path):
-                    pass
-                else:
-                    raise errors.TestError(
-                        'unable to find the needed public suffix list',
-                        {
-                            'Search_Dir': os.path.dirname(__file__),
-                            'function': 'http.HttpResponse.check_for_cookie'
-                        })
-                try:
-                    with open(psl_path, 'r', encoding='utf-8') as fo:
-                        for line in fo:
-                            if line[:2] == '//' or line[0] == ' ' or \
-                               line[0].strip() == '':
-                                continue
-                            if cover_domain == line.strip():
-                                return False
-                except IOError:
-                    raise errors.TestError(
-                        'unable to open the needed publix suffix list',
-                        {
-                            'path': psl_path,
-                            'function': 'http.HttpResponse.check_for_cookie'
-                        })
+                if get_public_suffix_list().is_public_suffix(cover_domain):
+                    return False
                 # Generate Origin Domain TLD
                 i = self.dest_addr.rfind('.')
                 o_tld = self.dest_addr[i + 1:]
@@ -169,67 +841,99 @@ class HttpResponse(object):
                     return False
                 return (cookie, self.dest_addr)
 
+    def is_reusable(self, method='GET'):
+        """
+        Check if the connection this response was read from can carry
+        another request. The response must be completely framed and the
+        server must not have asked for the connection to be closed
+        """
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            if 'close' in connection:
+                return False
+        elif self.version != 'HTTP/1.0' or 'keep-alive' not in connection:
+            return False
+        if self.body is None or self.status < 200:
+            return False
+        body_length = len(self.body)
+        if method == 'HEAD' or self.status in (204, 304):
+            return body_length == 0
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            return self.response.endswith(b'0' + self.CRLF + self.CRLF)
+        try:
+            return int(self.headers['content-length']) == body_length
+        except (KeyError, ValueError):
+            return False
+
+    @property
+    def headers(self):
+        """
+        Dictionary of response headers, keyed by lower case name
+        """
+        if self._headers is None:
+            self.parse_headers()
+        return self._headers
+
+    @property
+    def body(self):
+        """
+        memoryview of the raw response body, None if there is none
+        """
+        if self._headers is None:
+            self.parse_headers()
+        return self._body
+
+    @property
+    def data(self):
+        """
+        The response body with any transfer and content coding removed
+        """
+        if not self._data_decoded:
+            self._data = self.decode_body()
+            self._data_decoded = True
+        return self._data
+
+    @property
+    def cookie(self):
+        """
+        SimpleCookie built from the Set-Cookie header, None if there is none
+        """
+        if self._cookie is None and 'set-cookie' in self.headers:
+            self._cookie = self.parse_cookie(self.headers['set-cookie'])
+        return self._cookie
+
+    def has_set_cookie(self):
+        """
+        Cheap check for a Set-Cookie header without parsing the headers
+        """
+        header_end = self.response.find(self.CRLF + self.CRLF)
+        if header_end == -1:
+            header_end = len(self.response)
+        return SET_COOKIE_RE.search(self.response, 0, header_end) is not None
+
     def process_response(self):
         """
-        Parses an HTTP response after an HTTP request is sent
+        Fully parses an HTTP response, raising any error found in the
+        headers, cookie or body right away
         """
-        split_response = self.response.split(self.CRLF)
-        response_line = util.ensure_str(split_response[0])
-        response_headers = {}
-        response_data = None
-        data_line = None
-        for line_num in range(1, len(split_response[1:])):
-            # CRLF represents the start of data
-            if not split_response[line_num]:
-                data_line = line_num + 1
-                break
-            else:
-                # Headers are all split by ':'
-                header = split_response[line_num].split(b':', 1)
-                if len(header) != 2:
-                    raise errors.TestError(
-                        'Did not receive a response with valid headers',
-                        {
-                            'header_rcvd': str(header),
-                            'function': 'http.HttpResponse.process_response'
-                        })
-                header = util.ensure_str(header[0]), util.ensure_str(header[1])
-                response_headers[header[0].lower()] = header[1].lstrip()
-        if 'set-cookie' in list(response_headers.keys()):
-            try:
-                cookie = cookies.SimpleCookie()
-                cookie.load(response_headers['set-cookie'])
-            except cookies.CookieError as err:
-                raise errors.TestError(
-                    'Error processing the cookie content into a SimpleCookie',
-                    {
-                        'msg': str(err),
-                        'set_cookie': str(response_headers['set-cookie']),
-                        'function': 'http.HttpResponse.process_response'
-                    })
-            # if the check_for_cookie is invalid then we don't save it
-            if self.check_for_cookie(cookie) is False:
-                raise errors.TestError(
-                    'An invalid cookie was specified',
-                    {
-                        'set_cookie': str(response_headers['set-cookie']),
-                        'function': 'http.HttpResponse.process_response'
-                    })
-            else:
-                self.cookiejar.append((cookie, self.dest_addr))
-        if data_line is not None and data_line < len(split_response):
-            response_data = self.CRLF.join(split_response[data_line:])
+        self.headers
+        self.cookie
+        self.data
 
-        # if the output headers say there is encoding
-        if 'content-encoding' in list(response_headers.keys()):
-            response_data = self.parse_content_encoding(
-                response_headers, response_data)
+    def process_response_line(self):
+        """
+        Parses the status line of the response
+        """
+        line_end = self.response.find(self.CRLF)
+        if line_end == -1:
+            line_end = len(self.response)
+        response_line = util.ensure_str(self.response[:line_end])
         if len(response_line.split(' ', 2)) != 3:
             raise errors.TestError(
                 'The HTTP response line returned the wrong args',
                 {
                     'response_line': str(response_line),
-                    'function': 'http.HttpResponse.process_response'
+                    'function': 'http.HttpResponse.process_response_line'
                 })
         try:
             self.status = int(response_line.split(' ', 2)[1])
@@ -240,44 +944,151 @@ class HttpResponse(object):
                     'msg': 'This may be an HTTP 1.0 \'Simple Req\\Res\', it \
                     doesn\'t have HTTP headers and FTW will not parse these',
                     'response_line': str(response_line),
-                    'function': 'http.HttpResponse.process_response'
+                    'function': 'http.HttpResponse.process_response_line'
                 })
         self.status_msg = response_line.split(' ', 2)[2]
         self.version = response_line.split(' ', 2)[0]
         self.response_line = response_line
-        self.headers = response_headers
-        self.data = response_data
+
+    def parse_headers(self):
+        """
+        Parses the response headers. The header block and body are located
+        through offsets into the response, the body is exposed as a
+        memoryview without copying it
+        """
+        response = self.response
+        line_end = response.find(self.CRLF)
+        if line_end == -1:
+            line_end = len(response)
+        response_headers = {}
+        header_end = response.find(self.CRLF + self.CRLF)
+        if header_end != -1:
+            # CRLF represents the start of data
+            self._body_start = header_end + len(self.CRLF) * 2
+            self._body = memoryview(response)[self._body_start:]
+        else:
+            # Without an empty line the last line is never a header
+            header_end = response.rfind(self.CRLF)
+        header_start = line_end + len(self.CRLF)
+        if header_end > header_start:
+            for line in response[header_start:header_end].split(self.CRLF):
+                # Headers are all split by ':'
+                header = line.split(b':', 1)
+                if len(header) != 2:
+                    raise errors.TestError(
+                        'Did not receive a response with valid headers',
+                        {
+                            'header_rcvd': str(header),
+                            'function': 'http.HttpResponse.parse_headers'
+                        })
+                header = util.ensure_str(header[0]), util.ensure_str(header[1])
+                response_headers[header[0].lower()] = header[1].lstrip()
+        self._headers = response_headers
+
+    def parse_cookie(self, set_cookie):
+        """
+        Builds and validates a SimpleCookie from a Set-Cookie header
+        """
+        try:
+            cookie = cookies.SimpleCookie()
+            cookie.load(set_cookie)
+        except cookies.CookieError as err:
+            raise errors.TestError(
+                'Error processing the cookie content into a SimpleCookie',
+                {
+                    'msg': str(err),
+                    'set_cookie': str(set_cookie),
+                    'function': 'http.HttpResponse.parse_cookie'
+                })
+        # if the check_for_cookie is invalid then we don't save it
+        if self.check_for_cookie(cookie) is False:
+            raise errors.TestError(
+                'An invalid cookie was specified',
+                {
+                    'set_cookie': str(set_cookie),
+                    'function': 'http.HttpResponse.parse_cookie'
+                })
+        return cookie
+
+    def iter_data(self):
+        """
+        Generator yielding the received response body with any transfer
+        and content coding removed, decoding it in bounded pieces
+        """
+        response_headers = self.headers
+        response_data = self._body
+        if response_data is not None and \
+           'chunked' in response_headers.get('transfer-encoding', '').lower():
+            response_data = decode_chunked(self.response, self._body_start)
+        # if the output headers say there is encoding
+        if 'content-encoding' in list(response_headers.keys()):
+            yield from self.iter_content_decoded(
+                response_headers['content-encoding'], response_data)
+        elif response_data:
+            yield response_data
+
+    def decode_body(self):
+        """
+        Removes the transfer and content codings from the response body
+        """
+        if self.body is None and 'content-encoding' not in self.headers:
+            return None
+        return b''.join(self.iter_data())
 
 
 class HttpUA(object):
     """
     Act as the User Agent for our regression testing
     """
-    def __init__(self):
+    def __init__(self, connection_pool=None):
         """
-        Initalize an HTTP object
+        Initalize an HTTP object. Passing a ConnectionPool enables
+        persistent connections
         """
         self.request_object = None
         self.response_object = None
         self.request = None
-        self.cookiejar = []
+        self.extra_headers = {}
+        self.cookiejar = CookieJar()
         self.sock = None
+        self.sock_reused = False
+        self.connection_pool = connection_pool
         self.CIPHERS = \
             'ADH-AES256-SHA:ECDHE-ECDSA-AES128-GCM-SHA256:' \
             'ECDHE-RSA-AES128-GCM-SHA256:AES128-GCM-SHA256:AES128-SHA256:HIGH:'
+        self.VERIFY_CERTIFICATE = True
         self.CRLF = '\r\n'
         self.RECEIVE_BYTES = 8192
+        self.MAX_DECODED_SIZE = MAX_DECODED_SIZE
         self.SOCKET_TIMEOUT = 5
 
-    def send_request(self, http_request):
+    def send_request(self, http_request, extra_headers=None):
         """
-        Send a request and get response
+        Send a request and get response. extra_headers are added to the
+        headers of the request, unless it is raw or encoded
         """
         self.request_object = http_request
-        self.build_socket()
+        self.extra_headers = extra_headers or {}
         self.build_request()
+        self.build_socket()
+        if self.sock_reused:
+            # A pooled connection may have been closed by the server while
+            # it was idle, in that case we reconnect once transparently
+            try:
+                self.sock.sendall(self.request)
+                response = self.read_response_from_socket()
+            except OSError:
+                response = b''
+            except errors.TestError:
+                self.sock.close()
+                raise
+            if response:
+                self.process_response_data(response)
+                return
+            self.sock.close()
+            self.build_socket(reuse=False)
         try:
-            self.sock.send(self.request)
+            self.sock.sendall(self.request)
         except socket.error as err:
             raise errors.TestError(
                 'We were unable to send the request to the socket',
@@ -287,21 +1098,47 @@ class HttpUA(object):
                 })
         self.get_response()
 
-    def build_socket(self):
+    def get_connection_key(self):
+        """
+        Key identifying the connections a request can be sent over
+        """
+        return (self.request_object.protocol, self.request_object.dest_addr,
+                self.request_object.port)
+
+    def is_poolable(self):
+        """
+        Check if the request may go over a pooled connection. Raw and
+        encoded requests may pipeline or smuggle requests, so they get a
+        connection of their own that is never reused
+        """
+        return self.connection_pool is not None and \
+            self.request_object.raw_request is None and \
+            self.request_object.encoded_request is None
+
+    def build_socket(self, reuse=True):
         """
-        Generate either an HTTPS or HTTP socket
+        Generate either an HTTPS or HTTP socket, taking an idle one from
+        the connection pool if possible
         """
+        self.sock_reused = False
+        if reuse and self.is_poolable():
+            self.sock = self.connection_pool.get(self.get_connection_key())
+            if self.sock is not None:
+                self.sock.settimeout(self.SOCKET_TIMEOUT)
+                self.sock_reused = True
+                return
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.settimeout(self.SOCKET_TIMEOUT)
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             # Check if TLS
             if self.request_object.protocol == 'https':
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.set_ciphers(self.CIPHERS)
-                context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+                context = self.get_ssl_context()
                 self.sock = context.wrap_socket(
-                    self.sock, server_hostname=self.request_object.dest_addr)
+                    self.sock, server_hostname=self.request_object.dest_addr,
+                    session=get_tls_session(context,
+                                            self.request_object.dest_addr,
+                                            self.request_object.port))
             self.sock.connect(
                 (self.request_object.dest_addr, self.request_object.port))
         except socket.error as msg:
@@ -315,235 +1152,387 @@ class HttpUA(object):
                     'function': 'http.HttpUA.build_socket'
                 })
 
+    def get_ssl_context(self):
+        """
+        SSLContext used for https requests
+        """
+        return get_ssl_context(self.CIPHERS, self.VERIFY_CERTIFICATE)
+
+    def save_tls_session(self):
+        """
+        Keep the TLS session of the current connection for resumption
+        """
+        if isinstance(self.sock, ssl.SSLSocket) and \
+           self.sock.session is not None:
+            save_tls_session(self.sock.context,
+                             self.request_object.dest_addr,
+                             self.request_object.port, self.sock.session)
+
     def find_cookie(self):
         """
-        Find a list of all cookies for a given domain
+        Find a list of all cookies for the host and path of the request
         """
+        path = self.request_object.uri.split('?', 1)[0].split('#', 1)[0]
+        if not path.startswith('/'):
+            path = '/'
         return_cookies = []
-        origin_domain = self.request_object.dest_addr
-        for cookie in self.cookiejar:
-            for cookie_morsals in list(cookie[0].values()):
-                cover_domain = cookie_morsals['domain']
-                if cover_domain == '':
-                    if origin_domain == cookie[1]:
-                        return_cookies.append(cookie[0])
-                else:
-                    # Domain match algorithm
-                    bvalue = cover_domain.lower()
-                    hdn = origin_domain.lower()
-                    nend = hdn.find(bvalue)
-                    if nend is not False:
-                        return_cookies.append(cookie[0])
+        for morsel in self.cookiejar.get_cookies(
+                self.request_object.dest_addr, path):
+            cookie = cookies.SimpleCookie()
+            cookie[morsel.key] = morsel
+            return_cookies.append(cookie)
         return return_cookies
 
     def build_request(self):
-        request = '#method# #uri##version#%s#headers#%s#data#' % \
-                  (self.CRLF, self.CRLF)
-        request = request.replace(
-            '#method#', self.request_object.method)
-        # We add a space after here to account for HEAD requests with no url
-        request = request.replace(
-            '#uri#', self.request_object.uri + ' ')
-        request = request.replace(
-            '#version#', self.request_object.version)
+        """
+        Serialize the request object into self.request. Requests that do
+        not depend on stored cookies are cached on the request object
+        """
+        request_object = self.request_object
+        # If we have a Raw Request we should use that instead
+        if request_object.raw_request is not None:
+            if request_object.encoded_request is not None:
+                raise errors.TestError(
+                    'Cannot specify both raw and encoded modes',
+                    {
+                        'function': 'http.HttpUA.build_request'
+                    })
+            request = request_object.raw_request.encode('utf-8', 'strict')
+            # We do this regardless of magic if you want to send a literal
+            # '\' 'r' or 'n' use encoded request.
+            request = request.decode('unicode_escape')
+            self.request = util.ensure_binary(request)
+            return
+        if request_object.encoded_request is not None:
+            self.request = base64.b64decode(request_object.encoded_request)
+            return
+
         available_cookies = self.find_cookie()
-        # If the user has requested a tracked cookie and we have one set it
-        if available_cookies:
-            cookie_value = ''
-            if 'cookie' in list(self.request_object.headers.keys()):
-                # Create a SimpleCookie out of our provided cookie
-                try:
-                    provided_cookie = cookies.SimpleCookie()
-                    provided_cookie.load(self.request_object.headers['cookie'])
-                except cookies.CookieError as err:
-                    raise errors.TestError(
-                        'Error processing the existing cookie into a '
-                        'SimpleCookie',
-                        {
-                            'msg': str(err),
-                            'set_cookie':
-                                str(self.request_object.headers['cookie']),
-                            'function': 'http.HttpResponse.build_request'
-                        })
-                result_cookie = {}
-                for cookie_key, cookie_morsal in list(provided_cookie.items()):
-                    result_cookie[cookie_key] = \
-                        provided_cookie[cookie_key].value
-                for cookie in available_cookies:
-                    for cookie_key, cookie_morsal in cookie:
-                        if cookie_key in list(result_cookie.keys()):
-                            # we don't overwrite a user specified
-                            # cookie with a saved one
-                            pass
-                        else:
-                            result_cookie[cookie_key] = \
-                                cookie[cookie_key].value
-                for key, value in list(result_cookie.items()):
-                    cookie_value += (str(key) + '=' +
-                                     str(value) + '; ')
-                    # Remove the trailing semicolon
-                cookie_value = cookie_value[:-2]
-                self.request_object.headers['cookie'] = cookie_value
-            else:
-                for cookie in available_cookies:
-                    for cookie_key, cookie_morsal in list(cookie.items()):
-                        cookie_value += (str(cookie_key) + '=' +
-                                         str(cookie_morsal.coded_value) +
-                                         '; ')
-                        # Remove the trailing semicolon
-                    cookie_value = cookie_value[:-2]
-                    self.request_object.headers['cookie'] = cookie_value
-
-        # Expand out our headers into a string
-        headers = ''
-        if self.request_object.headers != {}:
-            for hname, hvalue in self.request_object.headers.items():
-                headers += str(hname) + ': ' + \
-                    str(hvalue) + self.CRLF
-        request = request.replace('#headers#', headers)
-
-        # If we have data append it
-        if self.request_object.data != '':
-            # Before we do that see if that is a charset
-            encoding = 'utf-8'
-            # Check to see if we have a content type and magic is
-            # off (otherwise UTF-8)
-            if 'Content-Type' in list(self.request_object.headers.keys()) and \
-               self.request_object.stop_magic is False:
-                pattern = re.compile(r'\;\s{0,1}?charset\=(.*?)(?:$|\;|\s)')
-                m = re.search(pattern,
-                              self.request_object.headers['Content-Type'])
-                if m:
-                    possible_choices = \
-                        list(set(encodings.aliases.aliases.keys())) + \
-                        list(set(encodings.aliases.aliases.values()))
-                    choice = m.group(1)
-                    # Python will allow these aliases but doesn't list them
-                    choice = choice.replace('-', '_')
-                    choice = choice.lower()
-                    if choice in possible_choices:
-                        encoding = choice
+        if not available_cookies:
+            cache_key = (request_object.method, request_object.uri,
+                         request_object.version,
+                         tuple(request_object.headers.items()),
+                         tuple(self.extra_headers.items()),
+                         request_object.data, request_object.stop_magic)
+            cached = request_object.request_cache
+            if cached is not None and cached[0] == cache_key:
+                self.request = cached[1]
+                return
+        else:
+            self.add_cookie_header(available_cookies)
+
+        data = b''
+        if request_object.data != '':
+            data = self.encode_data()
+        request = bytearray()
+        # We add a space after the uri to account for HEAD requests with
+        # no url
+        request += ('%s %s %s%s' % (request_object.method, request_object.uri,
+                                    request_object.version, self.CRLF)
+                    ).encode('utf-8', 'strict')
+        # Expand out our headers
+        for hname, hvalue in request_object.headers.items():
+            if hname == 'Content-Length' and \
+               request_object.magic_content_length:
+                # Count the bytes sent, not the characters of the data
+                hvalue = len(data)
+            request += ('%s: %s%s' % (hname, hvalue, self.CRLF)
+                        ).encode('utf-8', 'strict')
+        for hname, hvalue in self.extra_headers.items():
+            request += ('%s: %s%s' % (hname, hvalue, self.CRLF)
+                        ).encode('utf-8', 'strict')
+        request += CRLF_BYTES
+        request += data
+
+        # Use the request created
+        self.request = bytes(request)
+        if not available_cookies:
+            request_object.request_cache = (cache_key, self.request)
+
+    def add_cookie_header(self, available_cookies):
+        """
+        Merge the cookies we stored into the cookie header of the request,
+        user specified cookies are never overwritten
+        """
+        headers = self.request_object.headers
+        if 'cookie' in list(headers.keys()):
+            # Create a SimpleCookie out of our provided cookie
             try:
-                data_bytes = \
-                    self.request_object.data.encode(encoding, 'strict')
-            except UnicodeError as err:
+                provided_cookie = cookies.SimpleCookie()
+                provided_cookie.load(headers['cookie'])
+            except cookies.CookieError as err:
                 raise errors.TestError(
-                    'Error encoding the data with the charset specified',
+                    'Error processing the existing cookie into a '
+                    'SimpleCookie',
                     {
                         'msg': str(err),
-                        'Content-Type':
-                            str(self.request_object.headers['Content-Type']),
-                        'data': str(self.request_object.data),
+                        'set_cookie': str(headers['cookie']),
                         'function': 'http.HttpResponse.build_request'
                     })
-            data = util.ensure_str(data_bytes)
+            result_cookie = {}
+            for cookie_key, cookie_morsal in list(provided_cookie.items()):
+                result_cookie[cookie_key] = cookie_morsal.value
+            for cookie in available_cookies:
+                for cookie_key, cookie_morsal in list(cookie.items()):
+                    # we don't overwrite a user specified cookie with a
+                    # saved one
+                    if cookie_key not in result_cookie:
+                        result_cookie[cookie_key] = cookie_morsal.value
         else:
-            data = ''
+            result_cookie = {}
+            for cookie in available_cookies:
+                for cookie_key, cookie_morsal in list(cookie.items()):
+                    # Cookies come longest path first, which wins
+                    if cookie_key not in result_cookie:
+                        result_cookie[cookie_key] = cookie_morsal.coded_value
+        headers['cookie'] = '; '.join(
+            str(key) + '=' + str(value)
+            for key, value in list(result_cookie.items()))
 
-        request = request.replace('#data#', data).encode('utf-8', 'strict')
+    def encode_data(self):
+        """
+        Encode the request data with the charset of the Content-Type if
+        there is one and magic is on, otherwise UTF-8
+        """
+        encoding = 'utf-8'
+        headers = self.request_object.headers
+        if 'Content-Type' in list(headers.keys()) and \
+           self.request_object.stop_magic is False:
+            m = CHARSET_RE.search(headers['Content-Type'])
+            if m:
+                # Python will allow these aliases but doesn't list them
+                choice = m.group(1).replace('-', '_').lower()
+                if choice in ENCODING_ALIASES:
+                    encoding = choice
+        try:
+            return self.request_object.data.encode(encoding, 'strict')
+        except UnicodeError as err:
+            raise errors.TestError(
+                'Error encoding the data with the charset specified',
+                {
+                    'msg': str(err),
+                    'Content-Type': str(headers.get('Content-Type')),
+                    'data': str(self.request_object.data),
+                    'function': 'http.HttpResponse.build_request'
+                })
 
-        # If we have a Raw Request we should use that instead
-        if self.request_object.raw_request is not None:
-            if self.request_object.encoded_request is not None:
+    def get_response(self):
+        """
+        Get the response from the socket
+        """
+        try:
+            response = self.read_response_from_socket()
+        except errors.TestError:
+            self.sock.close()
+            raise
+        self.process_response_data(response)
+
+    def process_response_data(self, response):
+        """
+        Build the response object from the data read and either return
+        the connection to the pool or close it
+        """
+        # The session is only known once data has been read with TLS 1.3
+        self.save_tls_session()
+        try:
+            self.build_response(response)
+        except errors.TestError:
+            self.sock.close()
+            raise
+        if self.is_poolable():
+            try:
+                reusable = self.response_object.is_reusable(
+                    self.get_request_method())
+            except errors.TestError:
+                # Malformed headers are reported when the stage reads them,
+                # the connection just can't be trusted for another request
+                reusable = False
+            if reusable:
+                self.connection_pool.put(self.get_connection_key(),
+                                         self.sock)
+                return
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+            self.sock.close()
+        except OSError as err:
+            raise errors.TestError(
+                'We were unable to close the socket as expected.',
+                {
+                    'msg': err,
+                    'function': 'http.HttpUA.get_response'
+                })
+
+    def build_response(self, response):
+        """
+        Build the response object from the data read
+        """
+        if not response:
+            raise errors.TestError(
+                'No response from server.'
+                + ' Request likely timed out.',
+                {
+                    'host': self.request_object.dest_addr,
+                    'port': self.request_object.port,
+                    'proto': self.request_object.protocol,
+                    'msg': 'Please send the request and check'
+                    + ' Wireshark',
+                    'function': 'http.HttpUA.get_response'
+                })
+        self.response_object = HttpResponse(response, self)
+
+    def get_request_method(self):
+        """
+        Method of the request sent, taken from the request bytes so raw and
+        encoded requests are handled as well
+        """
+        return util.ensure_str(self.request.split(b' ', 1)[0],
+                               errors='replace')
+
+    def read_response_from_socket(self):
+        """
+        Read from the socket until the response is complete, the server
+        closes the connection or nothing arrives for SOCKET_TIMEOUT
+        """
+        reader = ResponseReader(self.get_request_method(),
+                                self.RECEIVE_BYTES)
+        self.sock.settimeout(self.SOCKET_TIMEOUT)
+        while not reader.complete:
+            try:
+                received = reader.recv_into(self.sock, self.RECEIVE_BYTES)
+            except socket.timeout:
+                if reader.length:
+                    # Unframed or truncated, use what we have
+                    break
                 raise errors.TestError(
-                    'Cannot specify both raw and encoded modes',
+                    f'No response from server within {self.SOCKET_TIMEOUT}s',
                     {
-                        'function': 'http.HttpUA.build_request'
+                        'host': self.request_object.dest_addr,
+                        'port': self.request_object.port,
+                        'proto': self.request_object.protocol,
+                        'msg': 'Please send the request and check Wireshark',
+                        'function': 'http.HttpUA.get_response'
                     })
-            request = self.request_object.raw_request.encode('utf-8', 'strict')
-            # We do this regardless of magic if you want to send a literal
-            # '\' 'r' or 'n' use encoded request.
-            request = request.decode('unicode_escape')
+            except OSError as err:
+                # A reset pooled connection is retried by send_request
+                if (isinstance(err, ConnectionResetError) and
+                        self.sock_reused and not reader.length):
+                    break
+                raise errors.TestError(
+                    'Failed to connect to server',
+                    {
+                        'host': self.request_object.dest_addr,
+                        'port': self.request_object.port,
+                        'proto': self.request_object.protocol,
+                        'message': err,
+                        'function': 'http.HttpUA.get_response'
+                    })
+            if not received:
+                reader.feed_eof()
+                break
+        return reader.getvalue()
 
-        if self.request_object.encoded_request is not None:
-            request = base64.b64decode(self.request_object.encoded_request)
 
-        # Use the request created
-        self.request = util.ensure_binary(request)
+class AsyncHttpUA(HttpUA):
+    """
+    asyncio flavour of HttpUA, send_request is a coroutine. Requests are
+    built and responses parsed exactly as HttpUA does, so many of them can
+    be kept in flight over a single event loop. Each AsyncHttpUA keeps its
+    own cookie jar and awaits one request at a time, so the stages of a
+    test should be sent in order through the same object
+    """
+    def __init__(self):
+        """
+        Initalize an HTTP object, connections are not pooled
+        """
+        HttpUA.__init__(self)
 
-    def get_response(self):
+    async def send_request(self, http_request, extra_headers=None):
         """
-        Get the response from the socket
+        Send a request and get response
         """
-        our_data = []
-        self.sock.setblocking(False)
+        self.request_object = http_request
+        self.extra_headers = extra_headers or {}
+        self.build_request()
+        stream_reader, stream_writer = await self.open_connection()
         try:
-            our_data = self.read_response_from_socket()
-        finally:
             try:
-                self.sock.shutdown(socket.SHUT_WR)
-                self.sock.close()
+                stream_writer.write(self.request)
+                await stream_writer.drain()
             except OSError as err:
                 raise errors.TestError(
-                    'We were unable to close the socket as expected.',
+                    'We were unable to send the request to the socket',
                     {
                         'msg': err,
-                        'function': 'http.HttpUA.get_response'
+                        'function': 'http.AsyncHttpUA.send_request'
                     })
-            else:
-                self.response_object = HttpResponse(b''.join(our_data), self)
-            finally:
-                if not b''.join(our_data):
-                    raise errors.TestError(
-                        'No response from server.'
-                        + ' Request likely timed out.',
-                        {
-                            'host': self.request_object.dest_addr,
-                            'port': self.request_object.port,
-                            'proto': self.request_object.protocol,
-                            'msg': 'Please send the request and check'
-                            + ' Wireshark',
-                            'function': 'http.HttpUA.get_response'
-                        })
+            response = await self.read_response_from_stream(stream_reader)
+        finally:
+            stream_writer.close()
+        self.build_response(response)
 
-    def read_response_from_socket(self):
-        # wait for socket to become ready
-        ready_sock, _, _ = select.select(
-            [self.sock], [], [self.sock], self.SOCKET_TIMEOUT)
-        if not ready_sock:
+    async def open_connection(self):
+        """
+        Open either an HTTPS or HTTP connection
+        """
+        context = None
+        server_hostname = None
+        if self.request_object.protocol == 'https':
+            context = self.get_ssl_context()
+            server_hostname = self.request_object.dest_addr
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.request_object.dest_addr, self.request_object.port,
+                    ssl=context, server_hostname=server_hostname),
+                self.SOCKET_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as msg:
             raise errors.TestError(
-                f'No response from server within {self.SOCKET_TIMEOUT}s',
+                'Failed to connect to server',
                 {
                     'host': self.request_object.dest_addr,
                     'port': self.request_object.port,
                     'proto': self.request_object.protocol,
-                    'msg': 'Please send the request and check Wireshark',
-                    'function': 'http.HttpUA.get_response'
+                    'message': msg,
+                    'function': 'http.AsyncHttpUA.open_connection'
                 })
 
-        our_data = []
-        while True:
+    async def read_response_from_stream(self, stream_reader):
+        """
+        Read from the stream until the response is complete, the server
+        closes the connection or nothing arrives for SOCKET_TIMEOUT
+        """
+        reader = ResponseReader(self.get_request_method(),
+                                self.RECEIVE_BYTES)
+        while not reader.complete:
             try:
-                data = self.sock.recv(self.RECEIVE_BYTES)
-                if len(data) == 0:
-                    # we're done
-                    break
-                our_data.append(util.ensure_binary(data))
-            except BlockingIOError as e:
-                # If we can't handle the error here, pass it on
-                if e.errno == socket.EAGAIN or e.errno == socket.EWOULDBLOCK:
-                    # we're done
+                data = await asyncio.wait_for(
+                    stream_reader.read(self.RECEIVE_BYTES),
+                    self.SOCKET_TIMEOUT)
+            except asyncio.TimeoutError:
+                if reader.length:
+                    # Unframed or truncated, use what we have
                     break
+                raise errors.TestError(
+                    f'No response from server within {self.SOCKET_TIMEOUT}s',
+                    {
+                        'host': self.request_object.dest_addr,
+                        'port': self.request_object.port,
+                        'proto': self.request_object.protocol,
+                        'msg': 'Please send the request and check Wireshark',
+                        'function': 'http.AsyncHttpUA.get_response'
+                    })
             except OSError as err:
-                # SSL will return SSLWantRead instead of EAGAIN
-                if (sys.platform == 'win32' and
-                        err.errno == errno.WSAEWOULDBLOCK):
-                    pass
-                elif (self.request_object.protocol == 'https' and
-                        err.args[0] == ssl.SSL_ERROR_WANT_READ):
-                    ready_sock, _, _ = select.select(
-                        [self.sock], [], [self.sock], SOCKET_TIMEOUT)
-                    if not ready_sock:
-                        break
-                # It's an error
-                else:
-                    raise errors.TestError(
-                        'Failed to connect to server',
-                        {
-                            'host': self.request_object.dest_addr,
-                            'port': self.request_object.port,
-                            'proto': self.request_object.protocol,
-                            'message': err,
-                            'function': 'http.HttpUA.get_response'
-                        })
-        return our_data
+                raise errors.TestError(
+                    'Failed to connect to server',
+                    {
+                        'host': self.request_object.dest_addr,
+                        'port': self.request_object.port,
+                        'proto': self.request_object.protocol,
+                        'message': err,
+                        'function': 'http.AsyncHttpUA.get_response'
+                    })
+            if not data:
+                reader.feed_eof()
+                break
+            reader.feed(data)
+        return reader.getvalue()
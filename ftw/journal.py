@@ -0,0 +1,355 @@
+import datetime
+import hashlib
+import queue
+import sqlite3
+import threading
+import zlib
+
+from dateutil import parser
+
+from . import util
+
+
+# Journal format written by instantiate_journal, kept in PRAGMA user_version
+# Journals from util.instantiate_database have no version and count as 1
+JOURNAL_VERSION = 2
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def get_version(conn):
+    """
+    Return the format version of the journal open on conn
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0] or 1
+
+
+def instantiate_journal(journal_file, tablename='ftw'):
+    """
+    Create a version 2 journal. Stage rows keep timestamps as integer
+    nanoseconds since the epoch and refer to their response by SHA-256, the
+    responses being stored once, zlib compressed, in {tablename}_responses
+    """
+    conn = sqlite3.connect(journal_file)
+    try:
+        create_tables(conn, tablename)
+        conn.execute('PRAGMA user_version = %d' % JOURNAL_VERSION)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def create_tables(conn, tablename='ftw'):
+    """
+    Create the version 2 journal tables on conn
+    """
+    conn.execute('CREATE TABLE {tn}(rule_id TEXT, test_id TEXT, '
+                 'time_start INTEGER, time_end INTEGER, response_hash TEXT, '
+                 'status_code INTEGER, stage INTEGER)'.format(tn=tablename))
+    conn.execute('CREATE TABLE {tn}_responses(hash TEXT PRIMARY KEY, '
+                 'response BLOB) WITHOUT ROWID'.format(tn=tablename))
+    create_index(conn, tablename)
+
+
+def to_ns(timestamp):
+    """
+    Convert a naive UTC datetime to nanoseconds since the epoch
+    """
+    delta = timestamp - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 +
+            delta.microseconds) * 1000
+
+
+def from_ns(timestamp_ns):
+    """
+    Convert nanoseconds since the epoch to a naive UTC datetime
+    """
+    return EPOCH + datetime.timedelta(microseconds=timestamp_ns // 1000)
+
+
+def hash_response(response):
+    """
+    Return the SHA-256 and the bytes of a journaled response
+    """
+    data = util.ensure_binary(response)
+    return hashlib.sha256(data).hexdigest(), data
+
+
+def insert_rows(conn, tablename, rows, stored_hashes=None):
+    """
+    Insert (rule_id, test_id, start, end, response, status, stage) rows
+    into the version 2 journal open on conn. Responses already in
+    stored_hashes, a set updated as responses are stored, are not
+    compressed again
+    """
+    if stored_hashes is None:
+        stored_hashes = set()
+    responses = []
+    stage_rows = []
+    for rule_id, test_id, start, end, response, status, stage in rows:
+        response_hash = None
+        if response is not None:
+            response_hash, data = hash_response(response)
+            if response_hash not in stored_hashes:
+                stored_hashes.add(response_hash)
+                responses.append((response_hash, zlib.compress(data)))
+        stage_rows.append((rule_id, test_id, to_ns(start), to_ns(end),
+                           response_hash, status, stage))
+    conn.executemany('INSERT OR IGNORE INTO {tn}_responses VALUES (?, ?)'.
+                     format(tn=tablename), responses)
+    conn.executemany('INSERT INTO {tn} VALUES (?, ?, ?, ?, ?, ?, ?)'.
+                     format(tn=tablename), stage_rows)
+
+
+def get_journaled_stages(journal_file, tablename='ftw'):
+    """
+    Return the set of (rule_id, test_id, stage) already in a journal, ids
+    as strings since version 1 journals may have stored them as numbers
+    """
+    conn = sqlite3.connect(journal_file)
+    conn.text_factory = str
+    try:
+        return set((str(rule_id), str(test_id), stage)
+                   for rule_id, test_id, stage in conn.execute(
+                       'SELECT rule_id, test_id, stage FROM {tn}'.format(
+                           tn=tablename)))
+    finally:
+        conn.close()
+
+
+def read_stage(conn, tablename, test_id, stage, version=None):
+    """
+    Return (start, end, response, status) journaled for a stage of a
+    test, start and end being naive UTC datetimes. None if the stage was
+    not journaled
+    """
+    if version is None:
+        version = get_version(conn)
+    if version < 2:
+        result = conn.execute(
+            'SELECT time_start, time_end, response_blob, status_code '
+            'FROM {tn} WHERE stage = ? AND test_id = ?'.format(tn=tablename),
+            (stage, test_id)).fetchone()
+        if result is None:
+            return None
+        return (parser.parse(result[0]), parser.parse(result[1]),
+                result[2], result[3])
+    result = conn.execute(
+        'SELECT j.time_start, j.time_end, r.response, j.status_code '
+        'FROM {tn} AS j LEFT JOIN {tn}_responses AS r '
+        'ON r.hash = j.response_hash '
+        'WHERE j.stage = ? AND j.test_id = ?'.format(tn=tablename),
+        (stage, test_id)).fetchone()
+    if result is None:
+        return None
+    response = zlib.decompress(result[2]) if result[2] is not None else None
+    return from_ns(result[0]), from_ns(result[1]), response, result[3]
+
+
+class JournalIndex(object):
+    """
+    In-memory index of a journal keyed by (test_id, stage), built by
+    streaming the table once so it can be shared by every test verified
+    against the journal. Timestamps and responses are only decoded when a
+    stage is looked up, responses of version 2 journals staying compressed
+    and deduplicated until then
+    """
+    def __init__(self, version=JOURNAL_VERSION):
+        self.version = version
+        self.stages = {}
+        self.responses = {}
+
+    def __len__(self):
+        return len(self.stages)
+
+    @classmethod
+    def load(cls, journal_file, tablename='ftw', rule_ids=None):
+        """
+        Index the journal in journal_file, only rows of the given rule_ids
+        if any. The first row journaled for a stage wins, as in
+        read_stage()
+        """
+        conn = sqlite3.connect(journal_file)
+        conn.text_factory = str
+        try:
+            index = cls(get_version(conn))
+            where = ''
+            params = ()
+            if rule_ids is not None:
+                params = tuple(rule_ids)
+                where = ' WHERE rule_id IN (%s)' % ', '.join('?' * len(params))
+            if index.version < 2:
+                cur = conn.execute(
+                    'SELECT test_id, stage, time_start, time_end, '
+                    'response_blob, status_code FROM {tn}'.format(
+                        tn=tablename) + where, params)
+            else:
+                cur = conn.execute(
+                    'SELECT test_id, stage, time_start, time_end, '
+                    'response_hash, status_code FROM {tn}'.format(
+                        tn=tablename) + where, params)
+            stages = index.stages
+            for row in cur:
+                stages.setdefault((row[0], row[1]), row[2:])
+            if index.version >= 2:
+                hashes = set(row[2] for row in stages.values())
+                for response_hash, response in conn.execute(
+                        'SELECT hash, response FROM {tn}_responses'.format(
+                            tn=tablename)):
+                    if response_hash in hashes:
+                        index.responses[response_hash] = response
+        finally:
+            conn.close()
+        return index
+
+    def get_stage(self, test_id, stage):
+        """
+        Return (start, end, response, status) journaled for a stage of a
+        test like read_stage(), None if the stage was not journaled
+        """
+        row = self.stages.get((test_id, stage))
+        if row is None:
+            return None
+        start, end, response, status = row
+        if self.version < 2:
+            return parser.parse(start), parser.parse(end), response, status
+        if response is not None:
+            response = zlib.decompress(self.responses[response])
+        return from_ns(start), from_ns(end), response, status
+
+
+def migrate(journal_file, tablename='ftw'):
+    """
+    Convert a version 1 journal, as built by util.instantiate_database, to
+    version 2 in place. Returns False if it was already up to date
+    """
+    conn = sqlite3.connect(journal_file, isolation_level=None)
+    conn.text_factory = str
+    try:
+        if get_version(conn) >= JOURNAL_VERSION:
+            return False
+        conn.execute('BEGIN')
+        try:
+            conn.execute('DROP INDEX IF EXISTS {tn}_test_stage'.
+                         format(tn=tablename))
+            conn.execute('ALTER TABLE {tn} RENAME TO {tn}_v1'.
+                         format(tn=tablename))
+            create_tables(conn, tablename)
+            stored_hashes = set()
+            cur = conn.execute(
+                'SELECT rule_id, test_id, time_start, time_end, '
+                'response_blob, status_code, stage FROM {tn}_v1'.
+                format(tn=tablename))
+            while True:
+                rows = cur.fetchmany(500)
+                if not rows:
+                    break
+                insert_rows(conn, tablename, [
+                    row[:2] + (parser.parse(row[2]), parser.parse(row[3])) +
+                    row[4:] for row in rows], stored_hashes)
+            conn.execute('DROP TABLE {tn}_v1'.format(tn=tablename))
+            conn.execute('PRAGMA user_version = %d' % JOURNAL_VERSION)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('VACUUM')
+        return True
+    finally:
+        conn.close()
+
+
+def create_index(conn, tablename='ftw'):
+    """
+    Index a journal table on (test_id, stage), the key stages are looked
+    up by when a journal is verified
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS {tn}_test_stage '
+                 'ON {tn}(test_id, stage)'.format(tn=tablename))
+
+
+class JournalWriter(object):
+    """
+    Writes journal rows through one sqlite connection owned by a dedicated
+    writer thread. The journal is switched to WAL with synchronous=NORMAL
+    and rows are inserted in transactions of up to batch_size rows, so
+    callers never wait on a commit. The journal MUST already exist, see
+    instantiate_journal() or util.instantiate_database(), and rows are
+    written in its format
+    """
+    def __init__(self, journal_file, tablename='ftw', batch_size=500):
+        self.journal_file = journal_file
+        self.tablename = tablename
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, rule_id, test_id, start, end, response, status, stage):
+        """
+        Queue a journal row for insertion
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((rule_id, test_id, start, end, response, status,
+                        stage))
+
+    def close(self):
+        """
+        Flush the queued rows and stop the writer thread, raising any error
+        the writer ran into
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        """
+        Writer thread, inserting queued rows in batches until close()
+        """
+        done = False
+        conn = sqlite3.connect(self.journal_file)
+        conn.text_factory = str
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            create_index(conn, self.tablename)
+            conn.commit()
+            version = get_version(conn)
+            ins_q = util.get_insert_statement(self.tablename)
+            stored_hashes = set()
+            while not done:
+                rows = [self.queue.get()]
+                while len(rows) < self.batch_size:
+                    try:
+                        rows.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in rows:
+                    done = True
+                    rows = rows[:rows.index(None)]
+                if rows and version >= 2:
+                    with conn:
+                        insert_rows(conn, self.tablename, rows,
+                                    stored_hashes)
+                elif rows:
+                    with conn:
+                        conn.executemany(ins_q, rows)
+        except Exception as e:
+            self.error = e
+            # Keep draining so close() never blocks on a dead writer
+            while not done:
+                done = self.queue.get() is None
+        finally:
+            conn.close()
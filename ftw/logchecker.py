@@ -1,4 +1,12 @@
 from abc import ABC, abstractmethod
+import os
+import re
+import threading
+import time
+
+
+# Shape of the markers TestRunner sends with marker_header
+MARKER_REGEX = r'ftw-[0-9a-f]{16}-[\w.-]+'
 
 
 class LogChecker(ABC):
@@ -10,11 +18,19 @@ class LogChecker(ABC):
     def __init__(self):
         self.start = None
         self.end = None
+        self.marker = None
 
     def set_times(self, start, end):
         self.start = start
         self.end = end
 
+    def set_marker(self, marker):
+        """
+        Called with the marker sent in the request of the next stage when
+        the testrunner has a marker_header, None when it could not be sent
+        """
+        self.marker = marker
+
     def mark_start(self, stage_id):
         """
         May be implemented to set up the log checker before
@@ -38,3 +54,250 @@ class LogChecker(ABC):
         implementers in pulling out the correct lines from the log file
         """
         pass
+
+
+class FileLogChecker(LogChecker):
+    """
+    LogChecker for a log file that the WAF appends to, such as the
+    ModSecurity error log. mark_start records the end of the file and
+    get_logs returns only the lines written after it, so the cost of a
+    stage is proportional to what it logged. A file rotated away (new
+    inode) is read to its end before the new file, a truncated one is read
+    again from the start
+    """
+    def __init__(self, log_file, encoding='utf-8', read_size=1024 * 1024):
+        super().__init__()
+        self.log_file = log_file
+        self.encoding = encoding
+        self.read_size = read_size
+        self.fd = None
+        self.offset = 0
+        self.lines = None
+
+    def mark_start(self, stage_id):
+        """
+        Keep the log file open at its current end, the open file follows
+        the inode if the log is rotated before mark_end
+        """
+        self.close()
+        self.lines = None
+        self.offset = 0
+        try:
+            self.fd = open(self.log_file, 'rb')
+        except FileNotFoundError:
+            return
+        self.offset = self.fd.seek(0, os.SEEK_END)
+
+    def mark_end(self, stage_id):
+        """
+        Read the lines logged since mark_start
+        """
+        self.lines = self.read_new_lines()
+
+    def get_logs(self):
+        """
+        Lines logged between mark_start and mark_end, read now if
+        mark_end was not called. Without mark_start, every line of the file
+        """
+        if self.lines is None:
+            self.lines = self.read_new_lines()
+        return self.lines
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def read_new_lines(self):
+        """
+        Read the data appended since mark_start, following rotation and
+        truncation, and split it into lines
+        """
+        lines = []
+        try:
+            if self.fd is not None:
+                fd_stat = os.fstat(self.fd.fileno())
+                try:
+                    path_stat = os.stat(self.log_file)
+                except FileNotFoundError:
+                    path_stat = None
+                if fd_stat.st_size < self.offset:
+                    # Truncated in place, everything in it is new
+                    self.offset = 0
+                lines.extend(self.read_lines(self.fd, self.offset))
+                rotated = path_stat is not None and \
+                    (path_stat.st_ino, path_stat.st_dev) != \
+                    (fd_stat.st_ino, fd_stat.st_dev)
+            else:
+                rotated = True
+            if rotated:
+                try:
+                    with open(self.log_file, 'rb') as fd:
+                        lines.extend(self.read_lines(fd, 0))
+                except FileNotFoundError:
+                    pass
+        finally:
+            self.close()
+        return lines
+
+    def read_lines(self, fd, offset):
+        """
+        Return the lines of fd from offset on, read in large chunks
+        """
+        chunks = []
+        fd.seek(offset)
+        while True:
+            chunk = fd.read(self.read_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks).decode(self.encoding, 'replace').splitlines()
+
+
+class MarkerLogIndex(object):
+    """
+    Index of the lines of a log file by the marker they carry, shared by
+    all the MarkerLogCheckers of a run. The file is read once, from where
+    it ended when the index was created, following rotation and
+    truncation. Lines matching group_regex, such as ModSecurity's
+    unique_id, are also attributed to the marker of any line with the same
+    group, so markers only need to be logged once per request
+    """
+    def __init__(self, log_file, marker_regex=MARKER_REGEX,
+                 group_regex=r'\[unique_id "([^"]+)"\]', encoding='utf-8',
+                 read_size=1024 * 1024):
+        self.log_file = log_file
+        self.marker_regex = re.compile(marker_regex)
+        self.group_regex = re.compile(group_regex) if group_regex else None
+        self.encoding = encoding
+        self.read_size = read_size
+        self.lock = threading.Lock()
+        self.lines = {}
+        self.groups = {}
+        self.marker_groups = {}
+        self.partial = b''
+        self.offset = 0
+        self.fd = None
+        try:
+            self.fd = open(self.log_file, 'rb')
+            self.offset = self.fd.seek(0, os.SEEK_END)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+
+    def get_lines(self, marker, timeout=0.0, quiet=0.2):
+        """
+        Return the lines logged for marker, waiting up to timeout seconds
+        for the log to show it. Once it does, the lines are only returned
+        after quiet seconds without new lines for marker, so lines logged
+        later for the same request, e.g. by a later phase, are not missed
+        """
+        now = time.monotonic()
+        deadline = now + timeout
+        changed = now
+        lines = []
+        while True:
+            with self.lock:
+                self.refresh()
+                found = list(self.lines.get(marker, ()))
+                for group in self.marker_groups.get(marker, ()):
+                    found.extend(line for line in self.groups[group]
+                                 if line not in found)
+            now = time.monotonic()
+            if len(found) != len(lines):
+                lines = found
+                changed = now
+            if now >= deadline or (lines and now - changed >= quiet):
+                return lines
+            time.sleep(0.05)
+
+    def refresh(self):
+        """
+        Index the lines appended since the last refresh
+        """
+        if self.fd is not None:
+            fd_stat = os.fstat(self.fd.fileno())
+            if fd_stat.st_size < self.offset:
+                # Truncated in place, everything in it is new
+                self.offset = 0
+                self.partial = b''
+            self.read(self.fd)
+            try:
+                path_stat = os.stat(self.log_file)
+            except FileNotFoundError:
+                return
+            if (path_stat.st_ino, path_stat.st_dev) == \
+               (fd_stat.st_ino, fd_stat.st_dev):
+                return
+            # Rotated, the old file was read to its end
+            self.fd.close()
+            self.fd = None
+        try:
+            self.fd = open(self.log_file, 'rb')
+        except FileNotFoundError:
+            return
+        self.offset = 0
+        self.index_data(self.partial + b'\n')
+        self.partial = b''
+        self.read(self.fd)
+
+    def read(self, fd):
+        """
+        Index the complete lines of fd from the current offset on
+        """
+        fd.seek(self.offset)
+        while True:
+            chunk = fd.read(self.read_size)
+            if not chunk:
+                break
+            self.offset += len(chunk)
+            data = self.partial + chunk
+            end = data.rfind(b'\n') + 1
+            self.partial = data[end:]
+            self.index_data(data[:end])
+
+    def index_data(self, data):
+        for line in data.decode(self.encoding, 'replace').splitlines():
+            markers = self.marker_regex.findall(line)
+            group_match = self.group_regex.search(line) \
+                if self.group_regex is not None else None
+            if group_match is not None:
+                group = group_match.group(1)
+                self.groups.setdefault(group, []).append(line)
+                for marker in markers:
+                    self.marker_groups.setdefault(marker, set()).add(group)
+            else:
+                for marker in markers:
+                    self.lines.setdefault(marker, []).append(line)
+
+
+class MarkerLogChecker(FileLogChecker):
+    """
+    LogChecker returning the lines a MarkerLogIndex holds for the marker
+    sent with the stage, for use with a TestRunner marker_header. Stages
+    run concurrently get exactly their own lines. Stages without a marker,
+    such as raw requests, fall back to FileLogChecker
+    """
+    def __init__(self, index, timeout=0.0, quiet=0.2):
+        super().__init__(index.log_file, index.encoding, index.read_size)
+        self.index = index
+        self.timeout = timeout
+        self.quiet = quiet
+
+    def mark_start(self, stage_id):
+        if self.marker is None:
+            super().mark_start(stage_id)
+
+    def mark_end(self, stage_id):
+        if self.marker is None:
+            super().mark_end(stage_id)
+
+    def get_logs(self):
+        if self.marker is None:
+            return super().get_logs()
+        return self.index.get_lines(self.marker, self.timeout, self.quiet)
@@ -3,6 +3,9 @@ from http.server import SimpleHTTPRequestHandler
 
 import pytest
 
+from . import http
+from . import journal
+from . import testrunner
 from . import util
 from .ruleset import Test
 
@@ -73,6 +76,20 @@ def http_serv_obj():
     return HTTPServer(('localhost', 80), SimpleHTTPRequestHandler)
 
 
+@pytest.fixture(scope='session')
+def connection_pool(request):
+    """
+    Return a connection pool shared by the whole session if keep-alive
+    connections were requested, None otherwise
+    """
+    if not request.config.getoption('--keep-alive'):
+        yield None
+        return
+    pool = http.ConnectionPool()
+    yield pool
+    pool.close()
+
+
 @pytest.fixture
 def with_journal(request):
     """
@@ -89,6 +106,60 @@ def tablename(request):
     return request.config.getoption('--tablename')
 
 
+@pytest.fixture(scope='session')
+def journal_index(request):
+    """
+    Return an index of the testing journal, loaded once for the whole
+    session, None if no journal was passed in
+    """
+    journal_file = request.config.getoption('--with-journal')
+    if journal_file is None:
+        return None
+    return journal.JournalIndex.load(
+        journal_file, request.config.getoption('--tablename') or 'ftw')
+
+
+@pytest.fixture(scope='session')
+def deferred_results(request, connection_pool):
+    """
+    Run every collected test once, up front, and evaluate their log checks
+    from a single read of the --deferred-log file. Stages are sent to
+    --destaddr, --port and --protocol when given. Returns a dictionary
+    mapping each test to its TestResult, None if --deferred-log was not
+    passed in
+    """
+    log_file = request.config.getoption('--deferred-log')
+    if log_file is None:
+        return None
+    overrides = [(name, request.config.getoption('--' + name))
+                 for name in ('destaddr', 'port', 'protocol')]
+    tests = []
+    seen = set()
+    for item in request.session.items:
+        test = getattr(item, 'callspec', None) and \
+            item.callspec.params.get('test')
+        if isinstance(test, Test) and id(test) not in seen:
+            seen.add(id(test))
+            tests.append(test)
+            for stage in test.stages:
+                apply_overrides(stage, overrides)
+    runner = testrunner.TestRunner(
+        connection_pool, request.config.getoption('--marker-header'))
+    return runner.run_tests_deferred(
+        tests, log_file, settle=request.config.getoption('--log-settle'))
+
+
+def apply_overrides(stage, overrides):
+    """
+    Point the input of a stage at the --destaddr, --port and --protocol
+    overrides, as test_default does
+    """
+    for name, value in overrides:
+        if value is not None:
+            setattr(stage.input, 'dest_addr' if name == 'destaddr' else name,
+                    value)
+
+
 def pytest_addoption(parser):
     """
     Adds command line options to py.test
@@ -112,6 +183,95 @@ def pytest_addoption(parser):
     parser.addoption('--protocol', action='store', default=None,
                      help='destination protocol to direct tests towards',
                      choices=['http', 'https'])
+    parser.addoption('--keep-alive', action='store_true', default=False,
+                     help='reuse connections across stages and tests')
+    parser.addoption('--compact', action='store_true', default=False,
+                     help='drop the YAML documents of tests once parsed')
+    parser.addoption('--rule-cache', action='store', default=None,
+                     help='directory caching parsed YAML files across runs')
+    parser.addoption('--load-jobs', action='store', default=None, type=int,
+                     help='load YAML files on this many processes, 0 for '
+                     'one per CPU')
+    parser.addoption('--rule-id', action='store', default=None,
+                     help='only load enabled tests whose rule_id starts '
+                     'with this')
+    parser.addoption('--ruleset-name', action='store', default=None,
+                     help='only load enabled tests of rulesets whose meta '
+                     'name matches this glob')
+    parser.addoption('--test-title', action='store', default=None,
+                     help='only load enabled tests whose title matches '
+                     'this regex')
+    parser.addoption('--deferred-log', action='store', default=None,
+                     help='run all tests first, then check this log file '
+                     'once, see the deferred_results fixture')
+    parser.addoption('--marker-header', action='store', default=None,
+                     help='send a per stage marker in this header to tell '
+                     'log lines apart')
+    parser.addoption('--log-settle', action='store', default=0.0,
+                     type=float,
+                     help='seconds to wait for the last log lines before '
+                     'deferred log checks')
+
+
+def load_rulesets(config, ruledir, recurse):
+    """
+    Load the rulesets of ruledir as the command line options ask. When
+    tests are filtered, only the selected enabled tests are built, which
+    the cached and parallel loaders cannot do
+    """
+    option = config.option
+    if option.rule_id or option.ruleset_name or option.test_title:
+        if option.rule_cache is not None or option.load_jobs is not None:
+            raise pytest.UsageError(
+                '--rule-id, --ruleset-name and --test-title cannot be '
+                'combined with --rule-cache or --load-jobs')
+        return list(util.iter_rulesets(
+            ruledir, recurse, rule_id=option.rule_id,
+            name=option.ruleset_name, enabled_only=True,
+            title=option.test_title, compact=option.compact))
+    return util.get_rulesets(ruledir, recurse, option.compact,
+                             option.rule_cache, option.load_jobs)
+
+
+class RulesetCache(object):
+    """
+    Rulesets loaded once per session and rule path, registered as a plugin
+    so every test function parametrized over the tests shares them. Under
+    pytest-xdist each worker collects, and so loads, on its own
+    """
+    name = 'ftw-rulesets'
+
+    def __init__(self, config):
+        self.config = config
+        self.rulesets = {}
+
+    def get_rulesets(self, ruledir, recurse):
+        """
+        Return the rulesets of ruledir, loading them on first use
+        """
+        key = (ruledir, recurse)
+        if key not in self.rulesets:
+            self.rulesets[key] = load_rulesets(self.config, ruledir, recurse)
+        return self.rulesets[key]
+
+
+def pytest_configure(config):
+    """
+    Register the session's RulesetCache
+    """
+    if not config.pluginmanager.has_plugin(RulesetCache.name):
+        config.pluginmanager.register(RulesetCache(config),
+                                      RulesetCache.name)
+
+
+def get_rulesets(config, ruledir, recurse):
+    """
+    Return the rulesets of ruledir from the session's RulesetCache
+    """
+    cache = config.pluginmanager.get_plugin(RulesetCache.name)
+    if cache is None:
+        return load_rulesets(config, ruledir, recurse)
+    return cache.get_rulesets(ruledir, recurse)
 
 
 def pytest_generate_tests(metafunc):
@@ -124,12 +284,15 @@ def pytest_generate_tests(metafunc):
     # args we want
     if [i for i in options if i in args and args[i] is not None]:
         if metafunc.config.option.ruledir:
-            rulesets = util.get_rulesets(metafunc.config.option.ruledir, False)
+            rulesets = get_rulesets(metafunc.config,
+                                    metafunc.config.option.ruledir, False)
         if metafunc.config.option.ruledir_recurse:
-            rulesets = util.get_rulesets(
-                metafunc.config.option.ruledir_recurse, True)
+            rulesets = get_rulesets(metafunc.config,
+                                    metafunc.config.option.ruledir_recurse,
+                                    True)
         if metafunc.config.option.rule:
-            rulesets = util.get_rulesets(metafunc.config.option.rule, False)
+            rulesets = get_rulesets(metafunc.config,
+                                    metafunc.config.option.rule, False)
         if 'test' in metafunc.fixturenames:
             use_rulesets = False
             arg_names = ['test']
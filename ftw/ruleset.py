@@ -1,4 +1,3 @@
-import re
 from urllib.parse import parse_qsl, unquote, urlencode
 
 from . import errors
@@ -10,13 +9,18 @@ class Output(object):
     This class holds the expected output from a corresponding FTW HTTP Input
     We are stricter in this definition by requiring at least one of status,
     response_contains, no_log_contains, expect_error, or log_contains
+    With compact the output dictionary is dropped once parsed
     """
-    def __init__(self, output_dict):
-        self.STATUS = 'status'
-        self.LOG = 'log_contains'
-        self.NOTLOG = 'no_log_contains'
-        self.RESPONSE = 'response_contains'
-        self.ERROR = 'expect_error'
+    __slots__ = ('output_dict', 'status', 'response_contains_str',
+                 'no_log_contains_str', 'log_contains_str', 'expect_error')
+
+    STATUS = 'status'
+    LOG = 'log_contains'
+    NOTLOG = 'no_log_contains'
+    RESPONSE = 'response_contains'
+    ERROR = 'expect_error'
+
+    def __init__(self, output_dict, compact=False):
         if output_dict is None:
             raise errors.TestError(
                 'No output dictionary found',
@@ -69,13 +73,15 @@ class Output(object):
                     'expect_error value': self.expect_error,
                     'function': 'ruleset.Output.__init__'
                 })
+        if compact:
+            self.output_dict = None
 
     def process_regex(self, key):
         """
         Extract the value of key from dictionary if available
         and process it as a python regex
         """
-        return re.compile(self.output_dict[key]) if \
+        return util.compile_regex(self.output_dict[key]) if \
             key in self.output_dict else None
 
 
@@ -83,6 +89,11 @@ class Input(object):
     """
     This class holds the data associated with an HTTP Input request in FTW
     """
+    __slots__ = ('raw_request', 'encoded_request', 'protocol', 'dest_addr',
+                 'port', 'method', 'uri', 'version', 'headers', 'data',
+                 'save_cookie', 'stop_magic', 'request_cache',
+                 'magic_content_length')
+
     def __init__(self, raw_request=None,
                  encoded_request=None,
                  protocol='http',
@@ -111,6 +122,10 @@ class Input(object):
             self.data = '\r\n'.join(self.data)
         self.save_cookie = save_cookie
         self.stop_magic = stop_magic
+        # The serialized request, filled in by the HttpUA that sends it
+        self.request_cache = None
+        # Set when Content-Length is ours to fill in with the encoded size
+        self.magic_content_length = False
         # Check if there is any data and do defaults
         if self.data != '':
             # Default values for content length and header
@@ -130,19 +145,23 @@ class Input(object):
                stop_magic is False:
                 # The two is for the trailing CRLF and the one after
                 headers['Content-Length'] = len(self.data)
+                self.magic_content_length = True
 
 
 class Stage(object):
     """
     This class holds information about 1 stage in a test, which contains
-    1 input and 1 output
+    1 input and 1 output. With compact the stage dictionary is dropped
+    once parsed
     """
-    def __init__(self, stage_dict, stage_index, test):
-        self.stage_dict = stage_dict
+    __slots__ = ('stage_dict', 'stage_index', 'test', 'input', 'output', 'id')
+
+    def __init__(self, stage_dict, stage_index, test, compact=False):
+        self.stage_dict = None if compact else stage_dict
         self.stage_index = stage_index
         self.test = test
         self.input = Input(**stage_dict['input'])
-        self.output = Output(stage_dict['output'])
+        self.output = Output(stage_dict['output'], compact)
         self.id = self.build_id()
 
     def build_id(self):
@@ -153,22 +172,28 @@ class Stage(object):
 class Test(object):
     """
     This class holds information for 1 test and potentially many stages
+    With compact the test dictionary is dropped once parsed
     """
-    def __init__(self, test_dict, test_index, ruleset_meta):
+    __slots__ = ('test_dict', 'test_index', 'ruleset_meta', 'test_title',
+                 'stages', 'enabled')
+
+    def __init__(self, test_dict, test_index, ruleset_meta, compact=False):
         self.test_dict = test_dict
         self.test_index = test_index
         self.ruleset_meta = ruleset_meta
         self.test_title = self.test_dict['test_title']
-        self.stages = self.build_stages()
+        self.stages = self.build_stages(compact)
         self.enabled = True
         if 'enabled' in self.test_dict:
             self.enabled = self.test_dict['enabled']
+        if compact:
+            self.test_dict = None
 
-    def build_stages(self):
+    def build_stages(self, compact=False):
         """
         Processes and loads an array of stages from the test dictionary
         """
-        return [Stage(stage_dict['stage'], index, self)
+        return [Stage(stage_dict['stage'], index, self, compact)
                 for index, stage_dict in enumerate(self.test_dict['stages'])]
 
 
@@ -176,23 +201,31 @@ class Ruleset(object):
     """
     This class holds test and stage information from a YAML test file
     These YAML files are used to test the OWASP/Modsec CRSv3 rules
+    With compact the loaded YAML document is dropped once parsed, keeping
+    only the meta dictionary. test_filter, if given, is called with each
+    test dictionary and only tests it returns true for are built, keeping
+    their index in the file
     """
-    def __init__(self, yaml_file):
+    def __init__(self, yaml_file, compact=False, test_filter=None):
         self.yaml_file = yaml_file
         self.meta = yaml_file['meta']
         self.author = self.meta['author']
         self.description = self.meta['description']
         self.enabled = self.meta['enabled']
-        self.tests = self.extract_tests() if self.enabled else []
+        self.tests = self.extract_tests(compact, test_filter) \
+            if self.enabled else []
+        if compact:
+            self.yaml_file = None
 
-    def extract_tests(self):
+    def extract_tests(self, compact=False, test_filter=None):
         """
         Processes a loaded YAML document and
         creates test objects based on input
         """
         try:
-            return [Test(test_dict, index, self.meta)
-                    for index, test_dict in enumerate(self.yaml_file['tests'])]
+            return [Test(test_dict, index, self.meta, compact)
+                    for index, test_dict in enumerate(self.yaml_file['tests'])
+                    if test_filter is None or test_filter(test_dict)]
         except errors.TestError as e:
             e.args[1]['meta'] = self.meta
             raise e
@@ -1,14 +1,145 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import datetime
+import itertools
+import os
+import re
 import sqlite3
+import threading
+import time
+import uuid
 
-from dateutil import parser
 import pytest
 
 from . import errors
 from . import http
+from . import journal
+from . import logchecker
 from . import util
 
 
+TestResult = collections.namedtuple('TestResult', ['test', 'error'])
+
+DeferredStage = collections.namedtuple('DeferredStage',
+                                       ['stage', 'start', 'marker'])
+
+# Characters of a stage id replaced in markers, see logchecker.MARKER_REGEX
+MARKER_UNSAFE_RE = re.compile(r'[^\w.-]')
+
+
+class LogAssertions(object):
+    """
+    Collects the log checks of the stages run by a TestRunner so they can
+    all be evaluated after the run from a single read of log_file, see
+    TestRunner.run_tests_deferred. A stage that sent a marker gets the
+    lines carrying it, and the lines sharing their group (group_regex,
+    ModSecurity's unique_id by default). Other stages get the lines
+    logged from their start until the next stage started, or until the
+    end of log_file for the last one. Those stages only start settle
+    seconds after the stage before them, so lines logged after the
+    response still land in the right window. Rotating log_file during the
+    run is not supported
+    """
+    def __init__(self, log_file, group_regex=r'\[unique_id "([^"]+)"\]',
+                 encoding='utf-8', settle=0.0):
+        self.log_file = log_file
+        self.settle = settle
+        self.group_regex = re.compile(group_regex) if group_regex else None
+        self.marker_regex = re.compile(logchecker.MARKER_REGEX)
+        self.encoding = encoding
+        self.lock = threading.Lock()
+        self.stages = []
+        self.offset = self.position()
+
+    def position(self):
+        """
+        Current size of log_file, where the next line will be logged
+        """
+        try:
+            return os.stat(self.log_file).st_size
+        except FileNotFoundError:
+            return 0
+
+    def start_stage(self, stage, marker=None):
+        """
+        Record the start of a stage, which also ends the log window of the
+        stage recorded before it
+        """
+        if marker is None and self.settle and self.stages:
+            time.sleep(self.settle)
+        with self.lock:
+            self.stages.append(DeferredStage(stage, self.position(), marker))
+
+    def read_lines(self):
+        """
+        Read the lines logged since the collector was created, returning
+        the offset of each line and the lines
+        """
+        offsets = []
+        lines = []
+        try:
+            with open(self.log_file, 'rb') as fd:
+                fd.seek(self.offset)
+                data = fd.read()
+        except FileNotFoundError:
+            return offsets, lines
+        offset = self.offset
+        for line in data.splitlines(True):
+            offsets.append(offset)
+            lines.append(line.decode(self.encoding, 'replace').rstrip('\r\n'))
+            offset += len(line)
+        return offsets, lines
+
+    def evaluate(self, check_logs):
+        """
+        Read the log once and call check_logs(stage, lines) for every
+        recorded stage. Returns a dictionary mapping each test with a
+        failed log check to its first AssertionError
+        """
+        offsets, lines = self.read_lines()
+        by_marker = {}
+        by_group = {}
+        marker_groups = {}
+        if any(deferred.marker is not None for deferred in self.stages):
+            for line in lines:
+                markers = self.marker_regex.findall(line)
+                group_match = self.group_regex.search(line) \
+                    if self.group_regex is not None else None
+                if group_match is not None:
+                    group = group_match.group(1)
+                    by_group.setdefault(group, []).append(line)
+                    for marker in markers:
+                        marker_groups.setdefault(marker, set()).add(group)
+                else:
+                    for marker in markers:
+                        by_marker.setdefault(marker, []).append(line)
+        failures = {}
+        for i, deferred in enumerate(self.stages):
+            test = deferred.stage.test
+            if test in failures or not (
+                    deferred.stage.output.log_contains_str or
+                    deferred.stage.output.no_log_contains_str):
+                continue
+            if deferred.marker is not None:
+                stage_lines = list(by_marker.get(deferred.marker, ()))
+                for group in marker_groups.get(deferred.marker, ()):
+                    stage_lines.extend(by_group[group])
+            else:
+                end = len(lines)
+                if i + 1 < len(self.stages):
+                    end = bisect.bisect_left(offsets, self.stages[i + 1].start)
+                stage_lines = lines[
+                    bisect.bisect_left(offsets, deferred.start):end]
+            try:
+                check_logs(deferred.stage, stage_lines)
+            except AssertionError:
+                failures[test] = AssertionError(
+                    'Log check failed for stage %s' % deferred.stage.id)
+        return failures
+
+
 class TestRunner(object):
     """
     Runner that accepts stages of a test and verifies expected and actual
@@ -16,6 +147,52 @@ class TestRunner(object):
     @TODO
     Accept logger objects for assertions
     """
+    def __init__(self, connection_pool=None, marker_header=None,
+                 log_assertions=None):
+        """
+        A ConnectionPool can be passed to reuse connections across the
+        stages run by this runner. With a marker_header, stages checking
+        logs send a unique marker in that header and hand it to the log
+        checker, see logchecker.MarkerLogChecker. With a LogAssertions,
+        log checks are recorded there instead of being run
+        """
+        self.connection_pool = connection_pool
+        self.marker_header = marker_header
+        self.log_assertions = log_assertions
+
+    def get_marker_headers(self, stage, logger_obj):
+        """
+        Build the marker of a stage, pass it to logger_obj and return the
+        extra headers carrying it. None without a marker_header or when
+        the stage does not check logs. Raw and encoded requests cannot
+        carry a marker, logger_obj is then told there is none
+        """
+        if self.marker_header is None or \
+           (logger_obj is None and self.log_assertions is None) or \
+           not (stage.output.log_contains_str or
+                stage.output.no_log_contains_str):
+            return None
+        if stage.input.raw_request is not None or \
+           stage.input.encoded_request is not None:
+            marker = None
+        else:
+            marker = 'ftw-%s-%s' % (uuid.uuid4().hex[:16],
+                                    MARKER_UNSAFE_RE.sub('_', stage.id))
+        if logger_obj is not None:
+            logger_obj.set_marker(marker)
+        return {self.marker_header: marker} if marker else None
+
+    def start_deferred_stage(self, stage, extra_headers):
+        """
+        Record the start of a stage in log_assertions. Stages without log
+        checks are recorded too, as they end the log window of the stage
+        before them
+        """
+        if self.log_assertions is None:
+            return
+        marker = extra_headers[self.marker_header] if extra_headers else None
+        self.log_assertions.start_stage(stage, marker)
+
     def test_status(self, expected_status, actual_status):
         """
         Compares the expected output against actual output of test and stage
@@ -32,15 +209,23 @@ class TestRunner(object):
         output stage. It will flag true on the first log_contains regex match
         and then assert on the flag at the end of the function
         """
-        found = False
-        for line in lines:
-            if log_contains.search(line):
-                found = True
-                break
         if negate:
-            assert not found
+            matcher = util.MultiMatcher(not_contains=[log_contains])
+            assert not matcher.scan(lines)[1]
         else:
-            assert found
+            matcher = util.MultiMatcher(contains=[log_contains])
+            assert not matcher.scan(lines)[0]
+
+    def check_logs(self, stage, lines):
+        """
+        Checks the log_contains and no_log_contains of a stage against
+        its log lines, in a single pass over the lines
+        """
+        missing, found = util.MultiMatcher(
+            [stage.output.log_contains_str],
+            [stage.output.no_log_contains_str]).scan(lines)
+        assert not found
+        assert not missing
 
     def test_response(self, response_object, regex):
         """
@@ -55,20 +240,15 @@ class TestRunner(object):
                     'response_object': response_object,
                     'function': 'testrunner.TestRunner.test_response'
                 })
-        if regex.search(util.ensure_str(response_object.response)):
-            assert True
-        else:
-            assert False
+        assert not util.MultiMatcher([regex]).scan(
+            [response_object.response])[0]
 
     def test_response_str(self, response, regex):
         """
         Checks if the response response contains a regex specified in the
         output stage. It will assert that the regex is present.
         """
-        if regex.search(util.ensure_str(response)):
-            assert True
-        else:
-            assert False
+        assert not util.MultiMatcher([regex]).scan([response])[0]
 
     def query_for_stage_results(self, tablename):
         """
@@ -83,68 +263,91 @@ class TestRunner(object):
         return q
 
     def run_stage_with_journal(self, rule_id, test, journal_file,
-                               tablename, logger_obj):
+                               tablename, logger_obj, journal_index=None):
         """
         Compare entries and responses in a journal file with a
         logger object.
         This will follow similar logic as run_stage, where a
         logger_obj.get_logs() MUST be implemented by the user so
         times can be retrieved and compared against the responses
-        logged in the journal db
+        logged in the journal db. A journal.JournalIndex of the journal
+        can be passed to look the stages up without querying it
         """
         assert logger_obj is not None
-        conn = sqlite3.connect(journal_file)
-        conn.text_factory = str
-        cur = conn.cursor()
-        for i, stage in enumerate(test.stages):
-            """
-            Query DB here for rule_id & test_title
-            Compare against logger_obj
-            """
-            q = self.query_for_stage_results(tablename)
-            results = cur.execute(q, [i, test.test_title]).fetchall()
-            if len(results) == 0:
-                raise errors.TestError(
-                    'SQL Query did not return results for test',
-                    {
-                        'rule_id': rule_id,
-                        'test': test.test_title,
-                        'query': q,
-                        'stage_num': i,
-                        'function':
-                            'testrunner.TestRunner.run_stage_with_journal'
-                    })
-            result = results[0]
-            start = parser.parse(result[2])
-            end = parser.parse(result[3])
-            response = result[4]
-            status = result[5]
-            if (stage.output.log_contains_str or
-               stage.output.no_log_contains_str):
-                logger_obj.set_times(start, end)
-                lines = logger_obj.get_logs()
-                if stage.output.log_contains_str:
-                    self.test_log(lines, stage.output.log_contains_str, False)
-                if stage.output.no_log_contains_str:
-                    # The last argument means that we should negate the resp
-                    self.test_log(lines, stage.output.no_log_contains_str,
-                                  True)
-            if stage.output.response_contains_str:
-                self.test_response_str(response,
-                                       stage.output.response_contains_str)
-            if stage.output.status:
-                self.test_status(stage.output.status, status)
+        if journal_index is not None:
+            conn = None
+            version = journal_index.version
+        else:
+            conn = sqlite3.connect(journal_file)
+            conn.text_factory = str
+        try:
+            if conn is not None:
+                version = journal.get_version(conn)
+            for i, stage in enumerate(test.stages):
+                """
+                Query DB here for rule_id & test_title
+                Compare against logger_obj
+                """
+                if journal_index is not None:
+                    result = journal_index.get_stage(test.test_title, i)
+                else:
+                    result = journal.read_stage(conn, tablename,
+                                                test.test_title, i, version)
+                if result is None:
+                    raise errors.TestError(
+                        'SQL Query did not return results for test',
+                        {
+                            'rule_id': rule_id,
+                            'test': test.test_title,
+                            'tablename': tablename,
+                            'journal_version': version,
+                            'stage_num': i,
+                            'function':
+                                'testrunner.TestRunner.run_stage_with_journal'
+                        })
+                start, end, response, status = result
+                self.check_journal_stage(stage, logger_obj, start, end,
+                                         response, status)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def check_journal_stage(self, stage, logger_obj, start, end, response,
+                            status):
+        """
+        Compares the expected output of a stage against a journaled
+        response and the logs between start and end
+        """
+        if (stage.output.log_contains_str or
+           stage.output.no_log_contains_str):
+            logger_obj.set_times(start, end)
+            self.check_logs(stage, logger_obj.get_logs())
+        if stage.output.response_contains_str:
+            self.test_response_str(response,
+                                   stage.output.response_contains_str)
+        if stage.output.status:
+            self.test_status(stage.output.status, status)
 
     def run_test_build_journal(self, rule_id, test, journal_file,
-                               tablename, http_ua=None):
+                               tablename, http_ua=None, journal_writer=None,
+                               skip_stages=()):
         """
         Build journal entries from a test within a specified rule_id
         Pass in the rule_id, test object, and path to journal_file
         DB MUST already be instantiated from util.instantiate_database()
+        or journal.instantiate_journal()
+        A journal.JournalWriter shared by the run can be passed to write
+        the entries, otherwise one is opened for the test. Stages whose
+        index is in skip_stages are already journaled, they are still sent
+        so cookies carry over but not written again
         """
-        conn = sqlite3.connect(journal_file)
-        conn.text_factory = str
-        cur = conn.cursor()
+        if len(set(skip_stages)) >= len(test.stages):
+            return
+        if journal_writer is None:
+            with journal.JournalWriter(journal_file, tablename) as writer:
+                return self.run_test_build_journal(
+                    rule_id, test, journal_file, tablename, http_ua, writer,
+                    skip_stages)
         for i, stage in enumerate(test.stages):
             response = None
             status = None
@@ -152,7 +355,7 @@ class TestRunner(object):
                 print('Running test %s from rule file %s' %
                       (test.test_title, rule_id))
                 if not http_ua:
-                    http_ua = http.HttpUA()
+                    http_ua = http.HttpUA(self.connection_pool)
                 start = datetime.datetime.utcnow()
                 http_ua.send_request(stage.input)
                 response = http_ua.response_object.response
@@ -163,10 +366,9 @@ class TestRunner(object):
                 status = -1
             finally:
                 end = datetime.datetime.utcnow()
-                ins_q = util.get_insert_statement(tablename)
-                cur.execute(ins_q, (rule_id, test.test_title, start,
-                                    end, response, status, i))
-                conn.commit()
+                if i not in skip_stages:
+                    journal_writer.write(rule_id, test.test_title, start, end,
+                                         response, status, i)
 
     def run_stage(self, stage, logger_obj=None, http_ua=None):
         """
@@ -174,42 +376,245 @@ class TestRunner(object):
         input, waits for output then compares expected vs actual output
         http_ua can be passed in to persist cookies
         """
+        start = end = None
+        extra_headers = self.get_marker_headers(stage, logger_obj)
+        self.start_deferred_stage(stage, extra_headers)
         # Send our request (exceptions caught as needed)
         if stage.output.expect_error:
             with pytest.raises(errors.TestError) as excinfo:
                 if not http_ua:
-                    http_ua = http.HttpUA()
+                    http_ua = http.HttpUA(self.connection_pool)
                 start = datetime.datetime.utcnow()
-                http_ua.send_request(stage.input)
+                http_ua.send_request(stage.input, extra_headers)
+                # Errors in the headers or body are only found on use
+                http_ua.response_object.process_response()
                 end = datetime.datetime.utcnow()
             print('\nExpected Error: %s' % str(excinfo))
         else:
             if not http_ua:
-                http_ua = http.HttpUA()
+                http_ua = http.HttpUA(self.connection_pool)
             if ((stage.output.log_contains_str or
                     stage.output.no_log_contains_str) and
                     logger_obj is not None):
                 logger_obj.mark_start(stage.id)
                 start = datetime.datetime.utcnow()
-            http_ua.send_request(stage.input)
+            http_ua.send_request(stage.input, extra_headers)
             if ((stage.output.log_contains_str or
                     stage.output.no_log_contains_str) and
                     logger_obj is not None):
                 logger_obj.mark_end(stage.id)
                 end = datetime.datetime.utcnow()
+        self.check_stage(stage, http_ua, logger_obj, start, end)
+
+    async def run_stage_async(self, stage, logger_obj=None, http_ua=None):
+        """
+        Coroutine flavour of run_stage, sending the stage input through an
+        AsyncHttpUA. http_ua can be passed in to persist cookies
+        """
+        start = end = None
+        extra_headers = self.get_marker_headers(stage, logger_obj)
+        self.start_deferred_stage(stage, extra_headers)
+        if not http_ua:
+            http_ua = http.AsyncHttpUA()
+        if stage.output.expect_error:
+            with pytest.raises(errors.TestError) as excinfo:
+                start = datetime.datetime.utcnow()
+                await http_ua.send_request(stage.input, extra_headers)
+                # Errors in the headers or body are only found on use
+                http_ua.response_object.process_response()
+                end = datetime.datetime.utcnow()
+            print('\nExpected Error: %s' % str(excinfo))
+        else:
+            if ((stage.output.log_contains_str or
+                    stage.output.no_log_contains_str) and
+                    logger_obj is not None):
+                logger_obj.mark_start(stage.id)
+                start = datetime.datetime.utcnow()
+            await http_ua.send_request(stage.input, extra_headers)
+            if ((stage.output.log_contains_str or
+                    stage.output.no_log_contains_str) and
+                    logger_obj is not None):
+                logger_obj.mark_end(stage.id)
+                end = datetime.datetime.utcnow()
+        self.check_stage(stage, http_ua, logger_obj, start, end)
+
+    def check_stage(self, stage, http_ua, logger_obj, start, end):
+        """
+        Compares the expected output of a stage against the response held
+        by http_ua and the logs between start and end
+        """
         if ((stage.output.log_contains_str or
                 stage.output.no_log_contains_str) and
-                logger_obj is not None):
+                logger_obj is not None and self.log_assertions is None):
             logger_obj.set_times(start, end)
-            lines = logger_obj.get_logs()
-            if stage.output.log_contains_str:
-                self.test_log(lines, stage.output.log_contains_str, False)
-            if stage.output.no_log_contains_str:
-                # The last argument means that we should negate the resp
-                self.test_log(lines, stage.output.no_log_contains_str, True)
+            self.check_logs(stage, logger_obj.get_logs())
         if stage.output.response_contains_str:
             self.test_response(http_ua.response_object,
                                stage.output.response_contains_str)
         if stage.output.status:
             self.test_status(stage.output.status,
                              http_ua.response_object.status)
+
+    def run_test(self, test, logger_obj=None):
+        """
+        Runs the stages of a test in order. Stages with save_cookie share
+        one HttpUA so cookies persist within the test, never across tests
+        """
+        test_ua = http.HttpUA(self.connection_pool)
+        for stage in test.stages:
+            if stage.input.save_cookie:
+                self.run_stage(stage, logger_obj, test_ua)
+            else:
+                self.run_stage(stage, logger_obj)
+
+    async def run_test_async(self, test, logger_obj=None):
+        """
+        Coroutine flavour of run_test
+        """
+        test_ua = http.AsyncHttpUA()
+        for stage in test.stages:
+            if stage.input.save_cookie:
+                await self.run_stage_async(stage, logger_obj, test_ua)
+            else:
+                await self.run_stage_async(stage, logger_obj)
+
+    def get_test_result(self, test, logger_factory):
+        """
+        Runs a test, returning a TestResult instead of raising
+        """
+        logger_obj = logger_factory() if logger_factory else None
+        try:
+            self.run_test(test, logger_obj)
+        except (Exception, pytest.fail.Exception) as e:
+            return TestResult(test, e)
+        return TestResult(test, None)
+
+    async def get_test_result_async(self, test, logger_factory):
+        """
+        Coroutine flavour of get_test_result
+        """
+        logger_obj = logger_factory() if logger_factory else None
+        try:
+            await self.run_test_async(test, logger_obj)
+        except (Exception, pytest.fail.Exception) as e:
+            return TestResult(test, e)
+        return TestResult(test, None)
+
+    def run_tests(self, tests, workers=8, logger_factory=None,
+                  use_async=False):
+        """
+        Runs an iterable of tests concurrently, on a pool of worker threads
+        or, with use_async, as tasks on an asyncio event loop. At most
+        workers tests are in flight at a time and the stages of each test
+        run strictly in order. This is a generator yielding a TestResult
+        as each test completes. logger_factory, if given, is called to
+        build the log checker of each test
+        """
+        if use_async:
+            yield from self.run_tests_async(tests, workers, logger_factory)
+            return
+        yield from self.run_concurrently(self.get_test_result, tests, workers,
+                                         logger_factory)
+
+    def run_tests_deferred(self, tests, log_file, workers=8, settle=0.0,
+                           log_assertions=None):
+        """
+        Runs tests like run_tests but, instead of reading the logs for
+        every stage, records the log checks of all stages and evaluates
+        them once the run is over, from a single read of log_file made
+        settle seconds after the last response. With a marker_header the
+        stages are told apart by marker. Otherwise they are told apart by
+        where in log_file they logged, which only holds if tests run one at
+        a time, so workers is then ignored and every stage also waits
+        settle seconds for the lines of the stage before it. Returns a
+        dictionary mapping each test to its TestResult
+        """
+        if self.marker_header is None:
+            workers = 1
+        if log_assertions is None:
+            log_assertions = LogAssertions(log_file, settle=settle)
+        runner = TestRunner(self.connection_pool, self.marker_header,
+                            log_assertions)
+        results = dict((result.test, result) for result in
+                       runner.run_concurrently(runner.get_test_result, tests,
+                                               workers, None))
+        if settle:
+            time.sleep(settle)
+        failures = log_assertions.evaluate(self.check_logs)
+        for test, error in failures.items():
+            if results[test].error is None:
+                results[test] = TestResult(test, error)
+        return results
+
+    def run_tests_with_journal(self, tests, journal_file, tablename,
+                               logger_factory, workers=8,
+                               journal_index=None):
+        """
+        Verifies an iterable of tests against a journal on a pool of
+        worker threads, see run_tests. The journal is indexed once, unless
+        a journal.JournalIndex is passed, and logger_factory is called to
+        build the log checker of each test
+        """
+        if journal_index is None:
+            journal_index = journal.JournalIndex.load(journal_file, tablename)
+        yield from self.run_concurrently(
+            self.get_journal_test_result, tests, workers, journal_file,
+            tablename, logger_factory, journal_index)
+
+    def get_journal_test_result(self, test, journal_file, tablename,
+                                logger_factory, journal_index):
+        """
+        Verifies a test against a journal, returning a TestResult instead
+        of raising
+        """
+        try:
+            self.run_stage_with_journal(test.ruleset_meta['name'], test,
+                                        journal_file, tablename,
+                                        logger_factory(), journal_index)
+        except (Exception, pytest.fail.Exception) as e:
+            return TestResult(test, e)
+        return TestResult(test, None)
+
+    def run_concurrently(self, function, tests, workers, *args):
+        """
+        Calls function(test, *args) for an iterable of tests on a pool of
+        worker threads, with at most workers in flight, yielding the
+        results as they complete
+        """
+        tests = iter(tests)
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            while True:
+                for test in itertools.islice(tests, workers - len(pending)):
+                    pending.add(executor.submit(function, test, *args))
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(
+                    pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def run_tests_async(self, tests, workers=8, logger_factory=None):
+        """
+        Runs an iterable of tests as tasks on a new event loop, see
+        run_tests
+        """
+        tests = iter(tests)
+        pending = set()
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                for test in itertools.islice(tests, workers - len(pending)):
+                    pending.add(loop.create_task(
+                        self.get_test_result_async(test, logger_factory)))
+                if not pending:
+                    break
+                done, pending = loop.run_until_complete(asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            loop.close()
@@ -1,11 +1,36 @@
+import concurrent.futures
+import fnmatch
+import functools
+import hashlib
+import itertools
 import os
 from glob import glob
+import pickle
+import re
 import sqlite3
+import tempfile
 
 import yaml
 
+from . import journal
 from . import ruleset
 
+try:
+    from yaml import CSafeLoader as FastSafeLoader
+except ImportError:
+    from yaml import SafeLoader as FastSafeLoader
+
+# Bumped whenever the pickled form of a Ruleset changes
+RULESET_CACHE_VERSION = 1
+# Number of compiled regexes interned by compile_regex
+REGEX_CACHE_SIZE = 4096
+# Escapes that mean something else when matched against UTF-8 bytes
+_UNICODE_ESCAPES = frozenset('wWbBdDsSxuUN0123456789')
+_INLINE_FLAGS_RE = re.compile(r'\(\?[aiLmsux-]')
+# Constructs that change meaning once a pattern is one branch of an
+# alternation: group references, named groups, conditionals, global flags
+_UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P|\(\?\(|\(\?[aiLmsux-]+\)')
+
 
 def get_insert_statement(table_name):
     """
@@ -47,13 +72,38 @@ def instantiate_database(sqlite_file='ftwj.sqlite'):
                col4_t=col4_t, col5=col5, col5_t=col5_t, col6=col6,
                col6_t=col6_t, col7=col7, col7_t=col7_t)
     cur.execute(q)
+    journal.create_index(conn, table_name)
     conn.commit()
     conn.close()
 
 
-def get_rulesets(ruledir, recurse):
+def get_rulesets(ruledir, recurse, compact=False, cache_dir=None,
+                 jobs=None):
     """
     List of ruleset objects extracted from the yaml directory
+    With compact the YAML documents are dropped once parsed. With a
+    cache_dir, parsed rulesets are kept there and only YAML files that
+    changed since are parsed again. With jobs the files are loaded by a
+    pool of that many processes (0 for one per CPU) using libyaml when
+    available, and the rulesets returned are always compact
+    """
+    yaml_files = get_yaml_files(ruledir, recurse)
+    if jobs is not None:
+        return load_rulesets_parallel(yaml_files, jobs, cache_dir)
+    if cache_dir is not None:
+        return [get_cached_ruleset(yaml_file, cache_dir, compact)
+                for yaml_file in yaml_files]
+    extracted_files = extract_yaml(yaml_files)
+    rulesets = []
+    for extracted_yaml in extracted_files:
+        rulesets.append(ruleset.Ruleset(extracted_yaml, compact))
+    return rulesets
+
+
+def get_yaml_files(ruledir, recurse):
+    """
+    List of the YAML files in ruledir, walking it if recurse, or ruledir
+    itself if it is a file
     """
     if os.path.isdir(ruledir) and recurse:
         yaml_files = [y for x in os.walk(ruledir, followlinks=True)
@@ -62,11 +112,146 @@ def get_rulesets(ruledir, recurse):
         yaml_files = get_files(ruledir, 'yaml')
     elif os.path.isfile(ruledir):
         yaml_files = [ruledir]
-    extracted_files = extract_yaml(yaml_files)
-    rulesets = []
-    for extracted_yaml in extracted_files:
-        rulesets.append(ruleset.Ruleset(extracted_yaml))
-    return rulesets
+    return yaml_files
+
+
+def iter_rulesets(ruledir, recurse, rule_id=None, name=None,
+                  enabled_only=False, title=None, compact=False):
+    """
+    Generator yielding the rulesets of the yaml directory one file at a
+    time, keeping only tests whose rule_id (or test_title when there is
+    none) starts with rule_id, from rulesets whose meta name matches the
+    glob name, whose test_title matches the regex title and, with
+    enabled_only, that are enabled. Filtered out files and tests never
+    get Test or Stage objects built, and with filters rulesets left
+    without tests are skipped
+    """
+    title_regex = compile_regex(title) if title is not None else None
+    filtered = rule_id is not None or title is not None or enabled_only
+
+    def test_filter(test_dict):
+        if enabled_only and not test_dict.get('enabled', True):
+            return False
+        if rule_id is not None and not str(
+                test_dict.get('rule_id', test_dict['test_title'])
+        ).startswith(str(rule_id)):
+            return False
+        if title_regex is not None and \
+           not title_regex.search(str(test_dict['test_title'])):
+            return False
+        return True
+
+    for yaml_file in get_yaml_files(ruledir, recurse):
+        loaded_yaml = parse_yaml(yaml_file, read_yaml_file(yaml_file))
+        meta = loaded_yaml['meta']
+        if name is not None and \
+           not fnmatch.fnmatchcase(str(meta.get('name', '')), name):
+            continue
+        if enabled_only and not meta['enabled']:
+            continue
+        loaded_ruleset = ruleset.Ruleset(
+            loaded_yaml, compact, test_filter if filtered else None)
+        if filtered and not loaded_ruleset.tests:
+            continue
+        yield loaded_ruleset
+
+
+def load_rulesets_parallel(yaml_files, jobs=0, cache_dir=None):
+    """
+    Load compact rulesets from yaml_files on a pool of jobs processes,
+    one per CPU if jobs is 0. Errors are reported per file as by
+    extract_yaml and the first one is raised
+    """
+    if not yaml_files:
+        return []
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, len(yaml_files) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(
+            load_ruleset, yaml_files, itertools.repeat(True),
+            itertools.repeat(cache_dir), itertools.repeat(FastSafeLoader),
+            chunksize=chunksize))
+
+
+def load_ruleset(yaml_file, compact=False, cache_dir=None, loader=None):
+    """
+    Build the Ruleset of a single YAML file, through cache_dir if given
+    """
+    if cache_dir is not None:
+        return get_cached_ruleset(yaml_file, cache_dir, compact, loader)
+    return ruleset.Ruleset(
+        parse_yaml(yaml_file, read_yaml_file(yaml_file), loader), compact)
+
+
+def get_cached_ruleset(yaml_file, cache_dir, compact=False, loader=None):
+    """
+    Return the Ruleset of yaml_file from cache_dir, parsing the file and
+    caching the result if it is missing or stale. Entries are keyed by
+    path and validated by mtime and size, then by a SHA-256 of the content
+    so touched but unchanged files are not parsed again. The cache is
+    pickled, only point cache_dir at a directory you trust
+    """
+    yaml_path = os.path.abspath(yaml_file)
+    cache_file = os.path.join(cache_dir, '%s.pickle' % hashlib.sha256(
+        yaml_path.encode('utf-8')).hexdigest())
+    st = os.stat(yaml_path)
+    entry = load_cache_entry(cache_file, yaml_path, compact)
+    if entry is not None and entry['mtime_ns'] == st.st_mtime_ns and \
+       entry['size'] == st.st_size:
+        return entry['ruleset']
+    content = read_yaml_file(yaml_file)
+    digest = hashlib.sha256(content).hexdigest()
+    if entry is not None and entry['sha256'] == digest:
+        parsed = entry['ruleset']
+    else:
+        parsed = ruleset.Ruleset(parse_yaml(yaml_file, content, loader),
+                                 compact)
+    entry = {
+        'version': RULESET_CACHE_VERSION,
+        'path': yaml_path,
+        'compact': compact,
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'sha256': digest,
+        'ruleset': parsed
+    }
+    save_cache_entry(cache_file, entry)
+    return parsed
+
+
+def load_cache_entry(cache_file, yaml_path, compact):
+    """
+    Load a ruleset cache entry, None if it is missing, unreadable or was
+    written for another path, mode or cache version
+    """
+    try:
+        with open(cache_file, 'rb') as fd:
+            entry = pickle.load(fd)
+    except Exception:
+        # Missing, corrupt or incompatible entries are all misses
+        return None
+    if not isinstance(entry, dict) or \
+       entry.get('version') != RULESET_CACHE_VERSION or \
+       entry.get('path') != yaml_path or entry.get('compact') != compact:
+        return None
+    return entry
+
+
+def save_cache_entry(cache_file, entry):
+    """
+    Atomically write a ruleset cache entry, so concurrent sessions never
+    read a partial file
+    """
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            pickle.dump(entry, fo, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
 
 
 def get_files(directory, extension):
@@ -84,21 +269,39 @@ def extract_yaml(yaml_files):
     """
     loaded_yaml = []
     for yaml_file in yaml_files:
-        try:
-            with open(yaml_file, encoding='utf-8') as fd:
-                loaded_yaml.append(yaml.safe_load(fd))
-        except IOError as e:
-            print('Error reading file', yaml_file)
-            raise e
-        except yaml.YAMLError as e:
-            print('Error parsing file', yaml_file)
-            raise e
-        except Exception as e:
-            print('General error')
-            raise e
+        loaded_yaml.append(parse_yaml(yaml_file, read_yaml_file(yaml_file)))
     return loaded_yaml
 
 
+def read_yaml_file(yaml_file):
+    """
+    Return the content of yaml_file as bytes
+    """
+    try:
+        with open(yaml_file, 'rb') as fd:
+            return fd.read()
+    except IOError as e:
+        print('Error reading file', yaml_file)
+        raise e
+
+
+def parse_yaml(yaml_file, content, loader=None):
+    """
+    Load the YAML document content read from yaml_file, with yaml.safe_load
+    unless another safe loader such as FastSafeLoader is given
+    """
+    try:
+        if loader is None:
+            return yaml.safe_load(content)
+        return yaml.load(content, Loader=loader)
+    except yaml.YAMLError as e:
+        print('Error parsing file', yaml_file)
+        raise e
+    except Exception as e:
+        print('General error')
+        raise e
+
+
 def ensure_str(s, encoding='utf-8', errors='strict'):
     # Optimization: Fast return for the common case.
     if isinstance(s, str):
@@ -115,3 +318,149 @@ def ensure_binary(s, encoding='utf-8', errors='strict'):
     if isinstance(s, str):
         return s.encode(encoding, errors)
     raise TypeError('not expecting type "%s"' % type(s))
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_regex(pattern, flags=0):
+    """
+    Process-wide interned re.compile, so the same pattern used by many
+    tests is only compiled and stored once
+    """
+    return re.compile(pattern, flags)
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_bytes_regex(pattern, flags=0):
+    """
+    Return a bytes regex matching UTF-8 encoded data exactly where the str
+    pattern matches the decoded text, None if the pattern has no such
+    equivalent. Only ASCII patterns without '.', character classes,
+    unicode aware escapes or case folding qualify
+    """
+    if isinstance(pattern, bytes):
+        return compile_regex(pattern, flags)
+    if flags & re.IGNORECASE or _INLINE_FLAGS_RE.search(pattern):
+        return None
+    try:
+        pattern_bytes = pattern.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+    escaped = False
+    for char in pattern:
+        if escaped:
+            if char in _UNICODE_ESCAPES:
+                return None
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in '.[':
+            return None
+    try:
+        return compile_regex(pattern_bytes, flags & ~re.UNICODE)
+    except re.error:
+        return None
+
+
+def combine_regexes(regexes):
+    """
+    Return one regex matching wherever any of the compiled regexes, all str
+    or all bytes, matches. None if they cannot be combined
+    """
+    if not regexes:
+        return None
+    if len(regexes) == 1:
+        return regexes[0]
+    if len(set(regex.flags for regex in regexes)) > 1:
+        return None
+    for regex in regexes:
+        pattern = ensure_str(regex.pattern)
+        if _UNCOMBINABLE_RE.search(pattern):
+            return None
+    if isinstance(regexes[0].pattern, bytes):
+        combined = b'|'.join(b'(?:' + regex.pattern + b')'
+                             for regex in regexes)
+    else:
+        combined = '|'.join('(?:' + regex.pattern + ')' for regex in regexes)
+    try:
+        return compile_regex(combined, regexes[0].flags)
+    except re.error:
+        return None
+
+
+class MultiMatcher(object):
+    """
+    Searches a sequence of chunks, lines or response bodies, for all the
+    contains and not_contains regexes of a stage in a single pass. Every
+    chunk is searched once with an alternation of the patterns and only
+    the rare chunks it matches are searched pattern by pattern. Bytes
+    chunks are searched undecoded when every pattern has a bytes
+    equivalent, see compile_bytes_regex. Patterns that cannot be combined
+    are searched one by one on every chunk
+    """
+    def __init__(self, contains=(), not_contains=()):
+        self.contains = [regex for regex in contains if regex is not None]
+        self.not_contains = [regex for regex in not_contains
+                             if regex is not None]
+        patterns = self.contains + self.not_contains
+        self.bytes_regexes = {}
+        for regex in patterns:
+            bytes_regex = compile_bytes_regex(regex.pattern, regex.flags)
+            if bytes_regex is None:
+                self.bytes_regexes = None
+                break
+            self.bytes_regexes[regex] = bytes_regex
+        self.combined = self.combine(patterns)
+        self.combined_not = self.combine(self.not_contains)
+
+    def combine(self, regexes):
+        """
+        Return the str and bytes alternations of regexes, and regexes
+        """
+        combined_bytes = None
+        if self.bytes_regexes is not None:
+            combined_bytes = combine_regexes(
+                [self.bytes_regexes[regex] for regex in regexes])
+        return combine_regexes(regexes), combined_bytes, regexes
+
+    def scan(self, chunks):
+        """
+        Return the contains regexes found in none of the chunks and the
+        not_contains regexes found in one. Stops at the first not_contains
+        match, or once every contains regex was found if there are no
+        not_contains
+        """
+        missing = list(self.contains)
+        if not missing and not self.not_contains:
+            return missing, []
+        combined = self.combined
+        for chunk in chunks:
+            if isinstance(chunk, bytes) and self.bytes_regexes is None:
+                chunk = ensure_str(chunk)
+            if isinstance(chunk, bytes):
+                regex_filter = combined[1]
+                regexes = self.bytes_regexes
+            else:
+                regex_filter = combined[0]
+                regexes = None
+            if regex_filter is not None:
+                if not regex_filter.search(chunk):
+                    continue
+                if len(combined[2]) == 1:
+                    # The filter is the only regex left, no need to search
+                    # the chunk again
+                    if self.not_contains:
+                        return missing, list(combined[2])
+                    missing = []
+                    break
+            found = [regex for regex in self.not_contains if
+                     (regexes[regex] if regexes else regex).search(chunk)]
+            if found:
+                return missing, found
+            if missing:
+                missing = [regex for regex in missing if not (
+                    regexes[regex] if regexes else regex).search(chunk)]
+                if not missing:
+                    if not self.not_contains:
+                        break
+                    combined = self.combined_not
+        return missing, []
@@ -125,13 +125,15 @@ def test_error5():
     """Invalid Header should cause error"""
     http_ua = http.HttpUA()
     with pytest.raises(errors.TestError):
-        http.HttpResponse('HTTP/1.1 200 OK\r\ntest\r\n', http_ua)
+        http.HttpResponse('HTTP/1.1 200 OK\r\ntest\r\n',
+                          http_ua).process_response()
 
 
 def test_error6():
     """Valid HTTP response should process fine"""
     http_ua = http.HttpUA()
-    http.HttpResponse('HTTP/1.1 200 OK\r\ntest: hello\r\n', http_ua)
+    http.HttpResponse('HTTP/1.1 200 OK\r\ntest: hello\r\n',
+                      http_ua).process_response()
 
 
 def test_error7():
@@ -139,7 +141,7 @@ def test_error7():
     http_ua = http.HttpUA()
     with pytest.raises(errors.TestError):
         http.HttpResponse('HTTP/1.1 200 OK\r\nContent-Encoding: XYZ\r\n',
-                          http_ua)
+                          http_ua).process_response()
 
 
 def test_error2():
@@ -171,7 +173,7 @@ def test_invalid_gzip():
     with pytest.raises(errors.TestError):
         http.HttpResponse('HTTP1.1 200 OK\r\n'
                           'Content-Encoding: gzip\r\n\r\ninvalid data',
-                          http_ua)
+                          http_ua).process_response()
 
 
 def test_invalid_deflate():
@@ -180,7 +182,7 @@ def test_invalid_deflate():
     with pytest.raises(errors.TestError):
         http.HttpResponse('HTTP1.1 200 OK\r\n'
                           'Content-Encoding: deflate\r\n\r\ninvalid data',
-                          http_ua)
+                          http_ua).process_response()
 
 
 def test_invalid_brotli():
@@ -189,7 +191,7 @@ def test_invalid_brotli():
     with pytest.raises(errors.TestError):
         http.HttpResponse('HTTP1.1 200 OK\r\n'
                           'Content-Encoding: br\r\n\r\ninvalid data',
-                          http_ua)
+                          http_ua).process_response()
 
 
 def test1():
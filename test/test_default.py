@@ -2,12 +2,12 @@ import pytest
 from ftw import testrunner, errors
 
 
-def test_default(ruleset, test, destaddr, port, protocol):
+def test_default(ruleset, test, destaddr, port, protocol, connection_pool):
     """
     Default tester with no logger obj. Useful for HTML contains and Status code
     Not useful for testing loggers
     """
-    runner = testrunner.TestRunner()
+    runner = testrunner.TestRunner(connection_pool)
     try:
         for stage in test.stages:
             if destaddr is not None:
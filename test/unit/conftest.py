@@ -0,0 +1,49 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import socketserver
+import threading
+
+import pytest
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'hello'
+        close = self.headers.get('Connection', '') == 'close'
+        self.wfile.write(
+            b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n' +
+            (b'Connection: close\r\n' if close else b'') + b'\r\n' + body)
+        self.close_connection = close
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve():
+    """
+    Factory starting a local HTTP server for a request handler
+    """
+    servers = []
+
+    def start(handler):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def http_server(serve):
+    return serve(KeepAliveHandler)
@@ -0,0 +1,430 @@
+from http import cookies
+from http.server import BaseHTTPRequestHandler
+import asyncio
+import shutil
+import socket
+import ssl
+import subprocess
+import time
+
+from ftw import errors, http, ruleset
+import pytest
+
+
+def test_public_suffix_list():
+    psl = http.get_public_suffix_list()
+    assert psl is http.get_public_suffix_list()
+    assert psl.is_public_suffix('com')
+    assert psl.is_public_suffix('CO.UK')
+    assert not psl.is_public_suffix('example.com')
+    # Wildcard and exception rules
+    assert psl.is_public_suffix('foo.ck')
+    assert not psl.is_public_suffix('www.ck')
+
+
+def test_public_suffix_cookie():
+    http_ua = http.HttpUA()
+    response = http.HttpResponse('HTTP/1.1 200 OK\r\n\r\n', http_ua)
+    response.dest_addr = 'www.example.com'
+    cookie = http.cookies.SimpleCookie('a=b; Domain=example.com')
+    assert response.check_for_cookie(cookie) == (cookie, 'www.example.com')
+    cookie = http.cookies.SimpleCookie('a=b; Domain=.com')
+    assert response.check_for_cookie(cookie) is False
+
+
+def test_is_ip_address():
+    assert http.is_ip_address('127.0.0.1')
+    assert http.is_ip_address('::1')
+    assert not http.is_ip_address('example.com')
+
+
+def test_registrable_domain():
+    psl = http.get_public_suffix_list()
+    assert psl.get_registrable_domain('a.b.example.com') == 'example.com'
+    assert psl.get_registrable_domain('www.example.co.uk') == \
+        'example.co.uk'
+    assert psl.get_registrable_domain('co.uk') == 'co.uk'
+
+
+def set_cookie(jar, header, origin):
+    jar.add(cookies.SimpleCookie(header), origin)
+
+
+def jar_names(jar, host, path='/'):
+    return [morsel.key for morsel in jar.get_cookies(host, path)]
+
+
+def test_cookie_jar_domain_and_path():
+    jar = http.CookieJar()
+    set_cookie(jar, 'a=1', 'www.example.com')
+    set_cookie(jar, 'b=1; Domain=.example.com', 'www.example.com')
+    set_cookie(jar, 'c=1; Path=/app', 'www.example.com')
+    assert jar_names(jar, 'www.example.com') == ['a', 'b']
+    assert jar_names(jar, 'api.example.com') == ['b']
+    assert jar_names(jar, 'www.example.com', '/app/x') == ['c', 'a', 'b']
+    assert jar_names(jar, 'www.example.com', '/apple') == ['a', 'b']
+    assert jar_names(jar, 'example.org') == []
+
+
+def test_cookie_jar_replace_and_expire():
+    jar = http.CookieJar()
+    set_cookie(jar, 'a=1', 'example.com')
+    set_cookie(jar, 'a=2', 'example.com')
+    assert len(jar) == 1
+    assert jar.get_cookies('example.com')[0].value == '2'
+    set_cookie(jar, 'a=3; Max-Age=0', 'example.com')
+    set_cookie(jar, 'b=1; Expires=Wed, 21 Oct 2015 07:28:00 GMT',
+               'example.com')
+    set_cookie(jar, 'c=1; Max-Age=3600', 'example.com')
+    assert jar_names(jar, 'example.com') == ['c']
+
+
+def test_cookie_jar_eviction():
+    jar = http.CookieJar(max_cookies=2)
+    set_cookie(jar, 'a=1', 'example.com')
+    set_cookie(jar, 'b=1', 'example.com')
+    # Using a makes b the least recently used
+    jar.get_cookies('example.com')
+    set_cookie(jar, 'a=1', 'example.com')
+    set_cookie(jar, 'c=1', 'example.com')
+    assert sorted(jar_names(jar, 'example.com')) == ['a', 'c']
+    assert list(jar.index['example.com']['/']) == [
+        ('example.com', '/', 'a'), ('example.com', '/', 'c')]
+
+
+def test_build_request():
+    http_ua = http.HttpUA()
+    http_ua.request_object = ruleset.Input(
+        uri='/x', headers={'Host': 'localhost'}, data='a=1',
+        stop_magic=True)
+    http_ua.build_request()
+    assert http_ua.request == \
+        b'GET /x HTTP/1.1\r\nHost: localhost\r\n\r\na=1'
+
+
+def test_build_request_charset():
+    http_ua = http.HttpUA()
+    http_ua.request_object = ruleset.Input(
+        headers={'Content-Type': 'text/plain; charset=latin-1'},
+        data=u'\xe9')
+    http_ua.build_request()
+    assert http_ua.request.endswith(b'\r\n\r\n\xe9')
+
+
+def test_build_request_content_length():
+    http_ua = http.HttpUA()
+    http_ua.request_object = ruleset.Input(
+        headers={'Content-Type': 'text/plain; charset=utf-16'}, data='ab')
+    http_ua.build_request()
+    body = 'ab'.encode('utf-16')
+    assert b'\r\nContent-Length: %d\r\n' % len(body) in http_ua.request
+    assert http_ua.request.endswith(b'\r\n\r\n' + body)
+    # A Content-Length given in the test is sent as is
+    http_ua.request_object = ruleset.Input(
+        headers={'Content-Type': 'text/plain; charset=utf-16',
+                 'Content-Length': 2}, data='ab')
+    http_ua.build_request()
+    assert b'\r\nContent-Length: 2\r\n' in http_ua.request
+
+
+def test_build_request_cache():
+    http_ua = http.HttpUA()
+    input_1 = ruleset.Input(headers={'Host': 'localhost'})
+    http_ua.request_object = input_1
+    http_ua.build_request()
+    request = http_ua.request
+    http_ua.build_request()
+    assert http_ua.request is request
+    # Changing the input invalidates the cached request
+    input_1.uri = '/changed'
+    http_ua.build_request()
+    assert http_ua.request.startswith(b'GET /changed ')
+
+
+def test_build_request_cookies():
+    http_ua = http.HttpUA()
+    http_ua.request_object = ruleset.Input(
+        dest_addr='127.0.0.1', headers={'Host': 'localhost'})
+    http_ua.build_request()
+    cached = http_ua.request_object.request_cache
+    http_ua.cookiejar.append(
+        (cookies.SimpleCookie('a=1; Path=/'), '127.0.0.1'))
+    http_ua.build_request()
+    assert b'\r\ncookie: a=1\r\n' in http_ua.request
+    assert http_ua.request_object.request_cache is cached
+
+
+def local_input(server, **kwargs):
+    kwargs.setdefault('headers', {'Host': 'localhost'})
+    return ruleset.Input(dest_addr='127.0.0.1', port=server.server_port,
+                         **kwargs)
+
+
+def test_connection_pool(http_server):
+    pool = http.ConnectionPool()
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(http_server))
+    assert http_ua.response_object.status == 200
+    assert not http_ua.sock_reused
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(http_server))
+    assert http_ua.response_object.status == 200
+    assert http_ua.sock_reused
+    pool.close()
+
+
+def test_connection_pool_stale(http_server):
+    pool = http.ConnectionPool()
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(http_server))
+    # Close the idle connection behind the pool's back
+    key = http_ua.get_connection_key()
+    pool.connections[key][0].shutdown(socket.SHUT_RDWR)
+    http_ua.send_request(local_input(http_server))
+    assert http_ua.response_object.status == 200
+    assert not http_ua.sock_reused
+    pool.close()
+
+
+def test_connection_close(http_server):
+    pool = http.ConnectionPool()
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(
+        http_server,
+        headers={'Host': 'localhost', 'Connection': 'close'}))
+    assert http_ua.response_object.status == 200
+    assert pool.connections == {}
+
+
+class PathHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = self.path.encode('utf-8')
+        self.wfile.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n'
+                         % len(body) + body)
+        self.wfile.flush()
+        if self.path == '/late':
+            time.sleep(.1)
+            self.wfile.write(b'HTTP/1.1 200 OK\r\n\r\n')
+
+    def log_message(self, *args):
+        pass
+
+
+def test_connection_pool_pipelined(serve):
+    server = serve(PathHandler)
+    pool = http.ConnectionPool()
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(
+        server, raw_request='GET /first HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        'GET /smuggled HTTP/1.1\r\nHost: localhost\r\n\r\n'))
+    assert pool.connections == {}
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(server, uri='/second'))
+    assert not http_ua.sock_reused
+    assert http_ua.response_object.data == b'/second'
+    pool.close()
+
+
+def test_connection_pool_late_data(serve):
+    server = serve(PathHandler)
+    pool = http.ConnectionPool()
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(server, uri='/late'))
+    time.sleep(.3)
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(server, uri='/second'))
+    assert not http_ua.sock_reused
+    assert http_ua.response_object.data == b'/second'
+    pool.close()
+
+
+class SilentHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/silent':
+            time.sleep(1)
+            return
+        self.wfile.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+
+    def log_message(self, *args):
+        pass
+
+
+def test_connection_pool_timeout(serve):
+    server = serve(SilentHandler)
+    pool = http.ConnectionPool()
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(server))
+    http_ua = http.HttpUA(pool)
+    http_ua.SOCKET_TIMEOUT = .2
+    with pytest.raises(errors.TestError):
+        http_ua.send_request(local_input(server, uri='/silent'))
+    assert http_ua.sock_reused
+    assert http_ua.sock.fileno() == -1
+    pool.close()
+
+
+class MalformedHeaderHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.wfile.write(b'HTTP/1.1 200 OK\r\nbad header\r\n'
+                         b'Content-Length: 5\r\n\r\nhello')
+
+    def log_message(self, *args):
+        pass
+
+
+def test_connection_pool_malformed_headers(serve):
+    pool = http.ConnectionPool()
+    http_ua = http.HttpUA(pool)
+    http_ua.send_request(local_input(serve(MalformedHeaderHandler)))
+    assert http_ua.response_object.status == 200
+    assert http_ua.sock.fileno() == -1
+    assert pool.connections == {}
+
+
+def test_reader_content_length():
+    reader = http.ResponseReader()
+    assert not reader.feed(b'HTTP/1.1 200 OK\r\nContent-Le')
+    assert not reader.feed(b'ngth: 5\r\n\r\nhel')
+    assert reader.status == 200
+    assert reader.feed(b'lo')
+    assert reader.framed
+
+
+def test_reader_chunked():
+    reader = http.ResponseReader()
+    assert not reader.feed(b'HTTP/1.1 200 OK\r\n'
+                           b'Transfer-Encoding: chunked\r\n\r\n'
+                           b'5\r\nhello\r\n')
+    assert not reader.feed(b'6;ext=1\r\n world\r\n0\r\n')
+    assert reader.feed(b'\r\n')
+    assert reader.framed
+    assert http.decode_chunked(reader.getvalue(), reader.body_start) == \
+        b'hello world'
+
+
+def test_reader_growth():
+    reader = http.ResponseReader(size=16)
+    reader.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 100000\r\n\r\n')
+    for _ in range(100):
+        reader.feed(b'x' * 1000)
+    assert reader.framed
+    assert reader.getvalue().endswith(b'\r\n\r\n' + b'x' * 100000)
+
+
+def test_response_body_view():
+    http_ua = http.HttpUA()
+    response = http.HttpResponse('HTTP/1.1 200 OK\r\nA: b\r\n\r\ncat', http_ua)
+    assert isinstance(response.body, memoryview)
+    assert response.body.obj is response.response
+    assert response.data == b'cat'
+    assert response.headers == {'a': 'b'}
+    response = http.HttpResponse('HTTP/1.1 200 OK\r\nA: b\r\n', http_ua)
+    assert response.body is None and response.data is None
+
+
+def test_reader_bodyless():
+    reader = http.ResponseReader('HEAD')
+    assert reader.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n')
+    reader = http.ResponseReader()
+    assert reader.feed(b'HTTP/1.1 304 Not Modified\r\n\r\n')
+
+
+def test_reader_until_eof():
+    reader = http.ResponseReader()
+    assert not reader.feed(b'HTTP/1.0 200 OK\r\n\r\nhello')
+    reader.feed_eof()
+    assert reader.complete and not reader.framed
+    reader = http.ResponseReader()
+    assert reader.feed(b'220 smtp.example.com ESMTP\r\n')
+
+
+def test_chunked_response_data():
+    http_ua = http.HttpUA()
+    response = http.HttpResponse('HTTP/1.1 200 OK\r\n'
+                                 'Transfer-Encoding: chunked\r\n\r\n'
+                                 '3\r\ncat\r\n0\r\n\r\n', http_ua)
+    assert response.data == b'cat'
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.wfile.write(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nhello')
+        self.wfile.flush()
+        time.sleep(.5)
+        self.wfile.write(b'world')
+
+
+def test_slow_response(serve):
+    http_ua = http.HttpUA()
+    http_ua.send_request(local_input(serve(SlowHandler)))
+    assert http_ua.response_object.data == b'helloworld'
+
+
+def test_async_http_ua(http_server):
+    async def send(http_ua):
+        await http_ua.send_request(local_input(http_server))
+        return http_ua.response_object
+
+    async def send_all():
+        return await asyncio.gather(
+            *[send(http.AsyncHttpUA()) for _ in range(10)])
+
+    loop = asyncio.new_event_loop()
+    try:
+        responses = loop.run_until_complete(send_all())
+    finally:
+        loop.close()
+    assert [r.status for r in responses] == [200] * 10
+    assert all(r.data == b'hello' for r in responses)
+
+
+def test_async_http_ua_error():
+    async def send(http_ua):
+        await http_ua.send_request(ruleset.Input(dest_addr='127.0.0.1',
+                                                 port=1))
+
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(errors.TestError):
+            loop.run_until_complete(send(http.AsyncHttpUA()))
+    finally:
+        loop.close()
+
+
+def test_ssl_context_cache():
+    context = http.get_ssl_context('HIGH')
+    assert context is http.get_ssl_context('HIGH')
+    assert context is not http.get_ssl_context('HIGH', verify=False)
+    assert http.get_ssl_context('HIGH', verify=False).verify_mode == \
+        ssl.CERT_NONE
+
+
+@pytest.mark.skipif(shutil.which('openssl') is None,
+                    reason='openssl is needed to build a certificate')
+def test_tls_session_resumption(tmp_path, http_server):
+    cert = str(tmp_path / 'cert.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', cert, '-out', cert, '-days', '1', '-subj', '/CN=ftw'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert)
+    http_server.socket = server_context.wrap_socket(http_server.socket,
+                                                    server_side=True)
+    sessions = []
+
+    class SessionHttpUA(http.HttpUA):
+        def save_tls_session(self):
+            sessions.append(self.sock.session_reused)
+            http.HttpUA.save_tls_session(self)
+
+    for _ in range(2):
+        http_ua = SessionHttpUA()
+        http_ua.VERIFY_CERTIFICATE = False
+        http_ua.send_request(local_input(http_server, protocol='https'))
+        assert http_ua.response_object.status == 200
+    assert sessions == [False, True]
@@ -0,0 +1,180 @@
+import datetime
+import sqlite3
+
+from ftw import errors, journal, logchecker, ruleset, testrunner, util
+import pytest
+
+
+def test_journal_writer(tmp_path):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    util.instantiate_database(journal_file)
+    start = datetime.datetime(2020, 1, 1)
+    with journal.JournalWriter(journal_file, batch_size=3) as writer:
+        for i in range(10):
+            writer.write('foo.yaml', 'test-%d' % i, start, start,
+                         'HTTP/1.1 200 OK', 200, 0)
+    conn = sqlite3.connect(journal_file)
+    assert conn.execute('SELECT COUNT(*) FROM ftw').fetchone() == (10,)
+    assert conn.execute(
+        'SELECT time_start, status_code FROM ftw WHERE test_id = ?',
+        ('test-3',)).fetchall() == [('2020-01-01 00:00:00', 200)]
+    assert conn.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    plan = conn.execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM ftw WHERE stage = ? AND '
+        'test_id = ?', (0, 'test-3')).fetchall()
+    assert 'ftw_test_stage' in str(plan)
+
+
+def test_journal_writer_error(tmp_path):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    writer = journal.JournalWriter(journal_file)
+    writer.write('foo.yaml', 'test', None, None, '', 200, 0)
+    # The table was never created
+    with pytest.raises(sqlite3.OperationalError):
+        writer.close()
+
+
+def write_journal(journal_file, rows):
+    with journal.JournalWriter(journal_file) as writer:
+        for row in rows:
+            writer.write(*row)
+
+
+def test_journal_v2(tmp_path):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    journal.instantiate_journal(journal_file)
+    start = datetime.datetime(2020, 1, 1, 0, 0, 0, 123456)
+    end = datetime.datetime(2020, 1, 1, 0, 0, 1)
+    forbidden = b'HTTP/1.1 403 Forbidden\r\n\r\n' + b'x' * 1000
+    write_journal(journal_file, [
+        ('foo.yaml', 'test-%d' % i, start, end, forbidden, 403, 0)
+        for i in range(10)] + [
+        ('foo.yaml', 'test-error', start, end, 'timed out', -1, 0)])
+    conn = sqlite3.connect(journal_file)
+    assert journal.get_version(conn) == 2
+    assert conn.execute('SELECT COUNT(*) FROM ftw_responses').fetchone() == \
+        (2,)
+    assert conn.execute(
+        'SELECT time_start FROM ftw WHERE test_id = ?',
+        ('test-1',)).fetchone() == (1577836800123456000,)
+    assert journal.read_stage(conn, 'ftw', 'test-1', 0) == \
+        (start, end, forbidden, 403)
+    assert journal.read_stage(conn, 'ftw', 'test-error', 0) == \
+        (start, end, b'timed out', -1)
+    assert journal.read_stage(conn, 'ftw', 'test-1', 1) is None
+
+
+def test_journal_migrate(tmp_path):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    util.instantiate_database(journal_file)
+    start = datetime.datetime(2020, 1, 1, 0, 0, 0, 123456)
+    write_journal(journal_file, [
+        ('foo.yaml', 'test-%d' % i, start, start, 'HTTP/1.1 200 OK', 200, 0)
+        for i in range(3)])
+    conn = sqlite3.connect(journal_file)
+    assert journal.get_version(conn) == 1
+    assert journal.read_stage(conn, 'ftw', 'test-1', 0) == \
+        (start, start, 'HTTP/1.1 200 OK', 200)
+    conn.close()
+    assert journal.migrate(journal_file)
+    assert not journal.migrate(journal_file)
+    conn = sqlite3.connect(journal_file)
+    assert journal.get_version(conn) == 2
+    assert journal.read_stage(conn, 'ftw', 'test-1', 0) == \
+        (start, start, b'HTTP/1.1 200 OK', 200)
+    assert conn.execute('SELECT COUNT(*) FROM ftw').fetchone() == (3,)
+    assert conn.execute('SELECT COUNT(*) FROM ftw_responses').fetchone() == \
+        (1,)
+
+
+class JournalLogChecker(logchecker.LogChecker):
+    def get_logs(self):
+        return ['%s %s' % (self.start.isoformat(), self.end.isoformat())]
+
+
+def test_run_stage_with_journal(tmp_path):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    journal.instantiate_journal(journal_file)
+    start = datetime.datetime(2020, 1, 1)
+    write_journal(journal_file, [
+        ('foo.yaml', 'test-1', start, start, b'HTTP/1.1 403 Forbidden', 403,
+         0)])
+    test = ruleset.Test(
+        {'test_title': 'test-1', 'stages': [{'stage': {
+            'input': {},
+            'output': {'status': 403, 'response_contains': 'Forbidden',
+                       'log_contains': '2020-01-01T00:00:00'}}}]},
+        0, {'name': 'foo.yaml'})
+    runner = testrunner.TestRunner()
+    runner.run_stage_with_journal('foo.yaml', test, journal_file, 'ftw',
+                                  JournalLogChecker())
+    test.test_title = 'test-2'
+    with pytest.raises(errors.TestError):
+        runner.run_stage_with_journal('foo.yaml', test, journal_file, 'ftw',
+                                      JournalLogChecker())
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_journal_index(tmp_path, version):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    if version == 1:
+        util.instantiate_database(journal_file)
+    else:
+        journal.instantiate_journal(journal_file)
+    start = datetime.datetime(2020, 1, 1)
+    write_journal(journal_file, [
+        ('%s.yaml' % rule, '%s-1' % rule, start, start, b'OK', 200, stage)
+        for rule in ('foo', 'bar') for stage in (0, 1)])
+    index = journal.JournalIndex.load(journal_file)
+    assert len(index) == 4
+    assert index.version == version
+    conn = sqlite3.connect(journal_file)
+    conn.text_factory = str
+    assert index.get_stage('foo-1', 1) == \
+        journal.read_stage(conn, 'ftw', 'foo-1', 1)
+    assert index.get_stage('foo-1', 2) is None
+    index = journal.JournalIndex.load(journal_file, rule_ids=['bar.yaml'])
+    assert sorted(index.stages) == [('bar-1', 0), ('bar-1', 1)]
+
+
+def test_run_tests_with_journal(tmp_path):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    journal.instantiate_journal(journal_file)
+    start = datetime.datetime(2020, 1, 1)
+    write_journal(journal_file, [
+        ('foo.yaml', 'test-%d' % i, start, start, b'OK', 200 + i, 0)
+        for i in range(2)])
+    tests = [ruleset.Test(
+        {'test_title': 'test-%d' % i, 'stages': [{'stage': {
+            'input': {}, 'output': {'status': 200}}}]},
+        i, {'name': 'foo.yaml'}) for i in range(3)]
+    runner = testrunner.TestRunner()
+    results = runner.run_tests_with_journal(tests, journal_file, 'ftw',
+                                            JournalLogChecker, workers=2)
+    errors_by_title = dict((result.test.test_title, result.error)
+                           for result in results)
+    assert errors_by_title['test-0'] is None
+    assert isinstance(errors_by_title['test-1'], AssertionError)
+    assert isinstance(errors_by_title['test-2'], errors.TestError)
+
+
+def test_run_test_build_journal_resume(tmp_path, http_server):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    journal.instantiate_journal(journal_file)
+    stage = {'input': {'dest_addr': '127.0.0.1',
+                       'port': http_server.server_port,
+                       'headers': {'Host': 'localhost'}},
+             'output': {'status': 200}}
+    test = ruleset.Test({'test_title': 'test-1',
+                         'stages': [{'stage': stage}, {'stage': stage}]},
+                        0, {'name': 'foo.yaml'})
+    runner = testrunner.TestRunner()
+    runner.run_test_build_journal('foo.yaml', test, journal_file, 'ftw',
+                                  skip_stages={0})
+    assert journal.get_journaled_stages(journal_file) == \
+        {('foo.yaml', 'test-1', 1)}
+    runner.run_test_build_journal('foo.yaml', test, journal_file, 'ftw')
+    assert len(journal.get_journaled_stages(journal_file)) == 2
+    index = journal.JournalIndex.load(journal_file)
+    assert index.get_stage('test-1', 1)[2:] == \
+        (b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello', 200)
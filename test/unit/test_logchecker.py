@@ -1,3 +1,5 @@
+import threading
+
 from ftw import logchecker
 import pytest
 
@@ -14,3 +16,93 @@ class LogChecker(logchecker.LogChecker):
 
 def test_logchecker_impl():
     LogChecker()
+
+
+def test_file_logchecker(tmp_path):
+    log_file = tmp_path / 'error.log'
+    log_file.write_text('old 1\nold 2\n')
+    checker = logchecker.FileLogChecker(str(log_file))
+    checker.mark_start('stage-1')
+    with open(str(log_file), 'a') as fd:
+        fd.write('new 1\nnew 2\n')
+    checker.mark_end('stage-1')
+    with open(str(log_file), 'a') as fd:
+        fd.write('later\n')
+    assert checker.get_logs() == ['new 1', 'new 2']
+    checker.mark_start('stage-2')
+    assert checker.get_logs() == []
+
+
+def test_file_logchecker_rotation(tmp_path):
+    log_file = tmp_path / 'error.log'
+    log_file.write_text('old\n')
+    checker = logchecker.FileLogChecker(str(log_file))
+    checker.mark_start('stage-1')
+    with open(str(log_file), 'a') as fd:
+        fd.write('before rotation')
+    log_file.rename(tmp_path / 'error.log.1')
+    log_file.write_text('after rotation\n')
+    checker.mark_end('stage-1')
+    assert checker.get_logs() == ['before rotation', 'after rotation']
+
+
+def test_file_logchecker_truncation(tmp_path):
+    log_file = tmp_path / 'error.log'
+    log_file.write_text('old line that is long\n')
+    checker = logchecker.FileLogChecker(str(log_file))
+    checker.mark_start('stage-1')
+    log_file.write_text('new\n')
+    checker.mark_end('stage-1')
+    assert checker.get_logs() == ['new']
+
+
+def test_file_logchecker_missing(tmp_path):
+    log_file = tmp_path / 'error.log'
+    checker = logchecker.FileLogChecker(str(log_file))
+    checker.mark_start('stage-1')
+    log_file.write_text('created\n')
+    checker.mark_end('stage-1')
+    assert checker.get_logs() == ['created']
+
+
+def test_marker_log_index(tmp_path):
+    log_file = tmp_path / 'error.log'
+    log_file.write_text('ftw-0123456789abcdef-old-0-0 before\n')
+    index = logchecker.MarkerLogIndex(str(log_file))
+    with open(str(log_file), 'a') as fd:
+        fd.write('ftw-0123456789abcdef-foo-0-0 one\n'
+                 'ftw-fedcba9876543210-foo-1-0 two\n'
+                 'ftw-0123456789abcdef-foo-0-0 thr')
+    assert index.get_lines('ftw-0123456789abcdef-foo-0-0') == \
+        ['ftw-0123456789abcdef-foo-0-0 one']
+    with open(str(log_file), 'a') as fd:
+        fd.write('ee\n')
+    log_file.rename(tmp_path / 'error.log.1')
+    log_file.write_text('ftw-fedcba9876543210-foo-1-0 four\n')
+    assert index.get_lines('ftw-0123456789abcdef-foo-0-0') == \
+        ['ftw-0123456789abcdef-foo-0-0 one',
+         'ftw-0123456789abcdef-foo-0-0 three']
+    assert index.get_lines('ftw-fedcba9876543210-foo-1-0') == \
+        ['ftw-fedcba9876543210-foo-1-0 two',
+         'ftw-fedcba9876543210-foo-1-0 four']
+    assert index.get_lines('ftw-0123456789abcdef-old-0-0') == []
+    index.close()
+
+
+def test_marker_log_index_late_lines(tmp_path):
+    log_file = tmp_path / 'error.log'
+    log_file.write_text('')
+    index = logchecker.MarkerLogIndex(str(log_file))
+
+    def write_line(text):
+        with open(str(log_file), 'a') as fd:
+            fd.write('ftw-0123456789abcdef-foo-0-0 %s\n' % text)
+
+    write_line('phase 1')
+    timer = threading.Timer(.1, write_line, ['phase 2'])
+    timer.start()
+    assert index.get_lines('ftw-0123456789abcdef-foo-0-0', 2.0, .3) == \
+        ['ftw-0123456789abcdef-foo-0-0 phase 1',
+         'ftw-0123456789abcdef-foo-0-0 phase 2']
+    timer.join()
+    index.close()
@@ -0,0 +1,47 @@
+from ftw import pytest_plugin, ruleset, util
+import pytest
+
+
+class FakeConfig(object):
+    class option(object):
+        rule_id = ruleset_name = test_title = None
+        compact = False
+        rule_cache = load_jobs = None
+
+
+def test_ruleset_cache(monkeypatch):
+    calls = []
+
+    def get_rulesets(ruledir, recurse, *args):
+        calls.append((ruledir, recurse))
+        return [object()]
+
+    monkeypatch.setattr(util, 'get_rulesets', get_rulesets)
+    cache = pytest_plugin.RulesetCache(FakeConfig())
+    first = cache.get_rulesets('yaml', False)
+    assert cache.get_rulesets('yaml', False) is first
+    assert cache.get_rulesets('yaml', True) is not first
+    assert calls == [('yaml', False), ('yaml', True)]
+
+
+def test_load_rulesets_filter_conflict():
+    class FilteredConfig(object):
+        class option(FakeConfig.option):
+            rule_id = '920'
+            rule_cache = 'cache'
+
+    with pytest.raises(pytest.UsageError):
+        pytest_plugin.load_rulesets(FilteredConfig(), 'yaml', False)
+
+
+def test_apply_overrides():
+    test = ruleset.Test({'test_title': '1', 'stages': [{'stage': {
+        'input': {'dest_addr': 'example.com', 'port': 80},
+        'output': {'status': 200}}}]}, 0, {'name': 'plugin.yaml'})
+    stage = test.stages[0]
+    pytest_plugin.apply_overrides(stage, [('destaddr', '127.0.0.1'),
+                                          ('port', None),
+                                          ('protocol', 'https')])
+    assert stage.input.dest_addr == '127.0.0.1'
+    assert stage.input.port == 80
+    assert stage.input.protocol == 'https'
@@ -1,6 +1,10 @@
 from ftw import testrunner, http, errors
+import brotli
+import gzip
+import os
 import pytest
 import re
+import zlib
 
 
 def test_response_before_response():
@@ -26,3 +30,94 @@ def test_response_success():
     runner.test_response(http.HttpResponse(
                          'HTTP/1.1 200 OK\r\n\r\ncat', http_ua),
                          re.compile('cat'))
+
+
+def test_response_lazy():
+    http_ua = http.HttpUA()
+    response = http.HttpResponse('HTTP/1.1 403 Forbidden\r\nbad header\r\n'
+                                 'Content-Encoding: gzip\r\n\r\nnot gzip',
+                                 http_ua)
+    assert response.status == 403
+    assert response.status_msg == 'Forbidden'
+    with pytest.raises(errors.TestError):
+        response.headers
+
+
+def test_response_cookie():
+    http_ua = http.HttpUA()
+    response = http.HttpResponse('HTTP/1.1 200 OK\r\n'
+                                 'Set-Cookie: a=b\r\n\r\n', http_ua)
+    assert response.cookie['a'].value == 'b'
+    assert list(http_ua.cookiejar) == [(response.cookie, '127.0.0.1')]
+
+
+def test_response_no_set_cookie():
+    http_ua = http.HttpUA()
+    for header in ['Set-Cookie2: a=b', 'X-Note: set-cookie stripped']:
+        response = http.HttpResponse('HTTP/1.1 200 OK\r\n%s\r\n\r\n' %
+                                     header, http_ua)
+        assert response.cookie is None
+    assert list(http_ua.cookiejar) == []
+
+
+def encoded_response(content_encoding, body, http_ua):
+    return http.HttpResponse(
+        b'HTTP/1.1 200 OK\r\nContent-Encoding: ' + content_encoding +
+        b'\r\n\r\n' + body, http_ua)
+
+
+def test_stacked_content_encoding():
+    http_ua = http.HttpUA()
+    body = brotli.compress(gzip.compress(b'cat' * 1000))
+    response = encoded_response(b'gzip, br', body, http_ua)
+    assert response.data == b'cat' * 1000
+
+
+def test_content_encoding_chunks():
+    http_ua = http.HttpUA()
+    data = os.urandom(200000)
+    for coding, body in [(b'gzip', gzip.compress(data)),
+                         (b'deflate', zlib.compress(data)[2:-4]),
+                         (b'br', brotli.compress(data))]:
+        response = encoded_response(coding, body, http_ua)
+        chunks = list(response.iter_data())
+        assert len(chunks) > 1
+        # brotli may overshoot its output limit by one buffer block
+        assert max(len(chunk) for chunk in chunks) <= \
+            2 * http.DECODE_CHUNK_SIZE
+        assert b''.join(chunks) == data
+
+
+def test_content_encoding_max_size():
+    http_ua = http.HttpUA()
+    http_ua.MAX_DECODED_SIZE = 1024 * 1024
+    body = gzip.compress(b'\0' * (10 * 1024 * 1024))
+    with pytest.raises(errors.TestError) as excinfo:
+        encoded_response(b'gzip', body, http_ua).data
+    assert excinfo.value.args[0].startswith('Decoded response data exceeds')
+    body = brotli.compress(b'\0' * (10 * 1024 * 1024))
+    with pytest.raises(errors.TestError):
+        encoded_response(b'br', body, http_ua).data
+
+
+def test_content_encoding_brotli_unlimited(monkeypatch):
+    class UnlimitedDecompressor(object):
+        def process(self, data):
+            return brotli.decompress(data)
+
+    monkeypatch.setattr(http.brotli, 'Decompressor', UnlimitedDecompressor)
+    http_ua = http.HttpUA()
+    body = brotli.compress(b'\0' * (10 * 1024 * 1024))
+    with pytest.raises(errors.TestError) as excinfo:
+        encoded_response(b'br', body, http_ua).data
+    assert excinfo.value.args[0].startswith('Brotli cannot limit its output')
+
+
+def test_content_encoding_truncated():
+    http_ua = http.HttpUA()
+    body = gzip.compress(b'cat' * 1000)
+    with pytest.raises(errors.TestError):
+        encoded_response(b'gzip', body[:-10], http_ua).data
+    response = encoded_response(b'gzip', body + body, http_ua)
+    assert response.data == b'cat' * 2000
+    assert encoded_response(b'gzip', b'', http_ua).data == b''
@@ -44,3 +44,19 @@ def test_testobj():
 def test_ruleset():
     with pytest.raises(KeyError):
         ruleset.Ruleset({})
+
+
+def test_compact():
+    ruleset_meta = {'name': 'test-name.yaml'}
+    stages_dict = {'test_title': 1, 'stages': [{'stage':
+                   {'output': {'status': 200}, 'input': {}}}]}
+    test = ruleset.Test(stages_dict, 0, ruleset_meta, compact=True)
+    assert test.test_dict is None
+    stage = test.stages[0]
+    assert stage.stage_dict is None
+    assert stage.output.output_dict is None
+    assert stage.output.status == 200
+    assert stage.id == 'test-name-0-0'
+    # The parsed objects carry no per instance dictionary
+    assert not hasattr(stage.input, '__dict__')
+    assert not hasattr(stage.output, '__dict__')
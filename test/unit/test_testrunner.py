@@ -0,0 +1,107 @@
+from http.server import BaseHTTPRequestHandler
+import threading
+import uuid
+
+from ftw import logchecker, ruleset, testrunner, util
+import pytest
+
+
+def build_tests(server, count, status=200):
+    ruleset_meta = {'name': 'test-runner.yaml'}
+    stage = {'stage': {'input': {'dest_addr': '127.0.0.1',
+                                 'port': server.server_port,
+                                 'headers': {'Host': 'localhost'}},
+                       'output': {'status': status}}}
+    return [ruleset.Test({'test_title': str(i), 'stages': [stage, stage]},
+                         i, ruleset_meta) for i in range(count)]
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_run_tests(http_server, use_async):
+    runner = testrunner.TestRunner()
+    tests = build_tests(http_server, 20)
+    results = list(runner.run_tests(tests, workers=4, use_async=use_async))
+    assert sorted(r.test.test_title for r in results) == \
+        sorted(t.test_title for t in tests)
+    assert all(r.error is None for r in results)
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_run_tests_failure(http_server, use_async):
+    runner = testrunner.TestRunner()
+    tests = build_tests(http_server, 3, status=404)
+    results = list(runner.run_tests(iter(tests), use_async=use_async))
+    assert len(results) == 3
+    assert all(isinstance(r.error, AssertionError) for r in results)
+
+
+def serve_logging(serve, log_file, delay=0):
+    log_lock = threading.Lock()
+
+    def write_log(rule_id, marker):
+        unique_id = uuid.uuid4().hex
+        with log_lock, open(str(log_file), 'a') as fd:
+            fd.write('[id "%s"] [unique_id "%s"]\n' % (rule_id, unique_id))
+            fd.write('[msg "%s"] [unique_id "%s"]\n' % (marker, unique_id))
+
+    class LoggingHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            args = (self.path[1:], self.headers['X-FTW-Marker'])
+            if not delay:
+                write_log(*args)
+            self.wfile.write(b'HTTP/1.0 200 OK\r\n\r\n')
+            if delay:
+                threading.Timer(delay, write_log, args).start()
+
+        def log_message(self, *args):
+            pass
+
+    return serve(LoggingHandler)
+
+
+def build_log_tests(server, count):
+    ruleset_meta = {'name': 'test-runner.yaml'}
+    return [ruleset.Test({'test_title': str(i), 'stages': [{'stage': {
+        'input': {'dest_addr': '127.0.0.1', 'port': server.server_port,
+                  'uri': '/%d' % i, 'headers': {'Host': 'localhost'}},
+        'output': {'log_contains': r'id "%d"\]' % i,
+                   'no_log_contains': r'id "%d"\]' % (i + 1)}}}]},
+        i, ruleset_meta) for i in range(count)]
+
+
+def test_run_tests_marker(serve, tmp_path):
+    log_file = tmp_path / 'error.log'
+    log_file.write_text('[id "0"] stale line\n')
+    tests = build_log_tests(serve_logging(serve, log_file), 10)
+    index = logchecker.MarkerLogIndex(str(log_file))
+    runner = testrunner.TestRunner(marker_header='X-FTW-Marker')
+    results = list(runner.run_tests(
+        tests, workers=4,
+        logger_factory=lambda: logchecker.MarkerLogChecker(index, 1.0)))
+    index.close()
+    assert [r.error for r in results] == [None] * 10
+
+
+@pytest.mark.parametrize('marker_header,workers', [('X-FTW-Marker', 4),
+                                                   (None, 4)])
+def test_run_tests_deferred(serve, tmp_path, marker_header, workers):
+    log_file = tmp_path / 'error.log'
+    log_file.write_text('[id "0"] stale line\n')
+    tests = build_log_tests(serve_logging(serve, log_file), 10)
+    # Expects the log line of the next test, failing only for the last one
+    tests[-1].stages[-1].output.no_log_contains_str = None
+    tests[-1].stages[-1].output.log_contains_str = \
+        util.compile_regex('id "10"')
+    runner = testrunner.TestRunner(marker_header=marker_header)
+    results = runner.run_tests_deferred(tests, str(log_file), workers)
+    assert [results[test].error for test in tests[:-1]] == [None] * 9
+    assert isinstance(results[tests[-1]].error, AssertionError)
+
+
+def test_run_tests_deferred_late_log(serve, tmp_path):
+    log_file = tmp_path / 'error.log'
+    log_file.write_text('')
+    tests = build_log_tests(serve_logging(serve, log_file, delay=.05), 5)
+    runner = testrunner.TestRunner()
+    results = runner.run_tests_deferred(tests, str(log_file), settle=.5)
+    assert [results[test].error for test in tests] == [None] * 5
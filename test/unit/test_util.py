@@ -0,0 +1,186 @@
+import os
+import re
+
+from ftw import ruleset, util
+import pytest
+import yaml
+
+
+def test_compile_regex_interned():
+    assert util.compile_regex('id "942100"') is \
+        util.compile_regex('id "942100"')
+    assert util.compile_regex('a', re.I) is not util.compile_regex('a')
+    output_1 = ruleset.Output({'log_contains': 'id "942100"'})
+    output_2 = ruleset.Output({'log_contains': 'id "942100"'})
+    assert output_1.log_contains_str is output_2.log_contains_str
+
+
+def test_compile_bytes_regex():
+    assert util.compile_bytes_regex('id "942100"').pattern == \
+        b'id "942100"'
+    assert util.compile_bytes_regex(r'HTTP/1\.1 40[0-9]') is None
+    assert util.compile_bytes_regex(r'hello\.world') is not None
+    assert util.compile_bytes_regex(r'hello\\.world') is None
+    assert util.compile_bytes_regex(r'id:\d+') is None
+    assert util.compile_bytes_regex('caf\xe9') is None
+    assert util.compile_bytes_regex('abc', re.I) is None
+    assert util.compile_bytes_regex('(?i)abc') is None
+    assert util.compile_bytes_regex('(?P<x>abc)') is not None
+
+
+def test_multi_matcher_response():
+    regex = re.compile('hello')
+    matcher = util.MultiMatcher([regex])
+    assert matcher.scan([b'\xff\xfe hello']) == ([], [])
+    assert matcher.scan(['hello']) == ([], [])
+    assert matcher.scan([b'world']) == ([regex], [])
+    matcher = util.MultiMatcher([re.compile(r'caf.')])
+    assert matcher.scan(['caf\xe9'.encode('utf-8')]) == ([], [])
+
+
+def test_combine_regexes():
+    combined = util.combine_regexes([re.compile('a|b'), re.compile('c')])
+    assert combined.pattern == '(?:a|b)|(?:c)'
+    assert util.combine_regexes([re.compile(r'(a)\1'), re.compile('c')]) \
+        is None
+    assert util.combine_regexes([re.compile('(?i)a'), re.compile('c')]) \
+        is None
+    assert util.combine_regexes([re.compile('a', re.I), re.compile('c')]) \
+        is None
+
+
+@pytest.mark.parametrize('chunk_type', [str, bytes])
+def test_multi_matcher(chunk_type):
+    def chunks(*texts):
+        return [text.encode('utf-8') if chunk_type is bytes else text
+                for text in texts]
+
+    hello, world, id_ = (re.compile('hello'), re.compile(r'wor.d'),
+                         re.compile(r'id "(\d+)" \1'))
+    matcher = util.MultiMatcher([hello, world], [id_])
+    assert matcher.scan(chunks('hello', 'nothing', 'world')) == ([], [])
+    assert matcher.scan(chunks('hello')) == ([world], [])
+    assert matcher.scan(chunks('hello world', 'id "1" 1')) == ([], [id_])
+    assert matcher.scan(chunks('id "1" 2', 'caf\xe9')) == ([hello, world], [])
+    matcher = util.MultiMatcher([hello], [None])
+    assert matcher.scan(chunks('hello', 'world')) == ([], [])
+    assert util.MultiMatcher().scan(chunks('hello')) == ([], [])
+
+
+def test_multi_matcher_early_exit():
+    seen = []
+
+    def chunks():
+        for chunk in ['hello', 'world', 'again']:
+            seen.append(chunk)
+            yield chunk
+
+    hello, world = re.compile('hello'), re.compile('world')
+    assert util.MultiMatcher([hello]).scan(chunks()) == ([], [])
+    assert seen == ['hello']
+    del seen[:]
+    assert util.MultiMatcher([hello], [world]).scan(chunks()) == \
+        ([], [world])
+    assert seen == ['hello', 'world']
+
+
+RULESET_YAML = '''---
+meta:
+  author: "ftw"
+  enabled: true
+  name: "cached.yaml"
+  description: "cached"
+tests:
+  - test_title: "%s"
+    stages:
+      - stage:
+          input: {}
+          output:
+            status: 200
+'''
+
+
+def test_ruleset_cache(tmp_path, monkeypatch):
+    yaml_file = tmp_path / 'cached.yaml'
+    yaml_file.write_text(RULESET_YAML % 'one')
+    cache_dir = str(tmp_path / 'cache')
+    rulesets = util.get_rulesets(str(yaml_file), False, cache_dir=cache_dir)
+    assert rulesets[0].tests[0].test_title == 'one'
+    parsed = []
+    parse_yaml = util.parse_yaml
+
+    def counting_parse_yaml(yaml_file, content, loader=None):
+        parsed.append(yaml_file)
+        return parse_yaml(yaml_file, content, loader)
+    monkeypatch.setattr(util, 'parse_yaml', counting_parse_yaml)
+    rulesets = util.get_rulesets(str(yaml_file), False, cache_dir=cache_dir)
+    assert rulesets[0].tests[0].test_title == 'one'
+    assert rulesets[0].tests[0].stages[0].output.status == 200
+    # Touching the file only checks the content hash
+    st = yaml_file.stat()
+    os.utime(str(yaml_file), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    util.get_rulesets(str(yaml_file), False, cache_dir=cache_dir)
+    assert parsed == []
+    yaml_file.write_text(RULESET_YAML % 'two')
+    rulesets = util.get_rulesets(str(yaml_file), False, cache_dir=cache_dir)
+    assert rulesets[0].tests[0].test_title == 'two'
+    assert parsed == [str(yaml_file)]
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_get_rulesets_parallel(tmp_path, capfd):
+    for title in ('one', 'two', 'three'):
+        (tmp_path / ('%s.yaml' % title)).write_text(RULESET_YAML % title)
+    rulesets = util.get_rulesets(str(tmp_path), False, jobs=2)
+    assert sorted(r.tests[0].test_title for r in rulesets) == \
+        ['one', 'three', 'two']
+    assert rulesets[0].yaml_file is None
+    assert rulesets[0].tests[0].stages[0].test is rulesets[0].tests[0]
+    (tmp_path / 'broken.yaml').write_text('meta: [')
+    with pytest.raises(yaml.YAMLError):
+        util.get_rulesets(str(tmp_path), False, jobs=2)
+    assert 'Error parsing file %s' % (tmp_path / 'broken.yaml') in \
+        capfd.readouterr().out
+
+
+FILTER_YAML = '''---
+meta:
+  author: "ftw"
+  enabled: %s
+  name: "%s.yaml"
+  description: "filtered"
+tests:
+  - test_title: "%s-1"
+    stages:
+      - stage:
+          input: {}
+          output:
+            status: 200
+  - test_title: "%s-2"
+    enabled: false
+    stages:
+      - stage:
+          input: {}
+          output:
+            status: 200
+'''
+
+
+def test_iter_rulesets(tmp_path):
+    for name, enabled in (('942100', 'true'), ('942200', 'true'),
+                          ('920100', 'false')):
+        (tmp_path / ('%s.yaml' % name)).write_text(
+            FILTER_YAML % (enabled, name, name, name))
+    rulesets = util.iter_rulesets(str(tmp_path), False, rule_id='942')
+    assert not isinstance(rulesets, list)
+    assert sorted(test.test_title for r in rulesets for test in r.tests) == \
+        ['942100-1', '942100-2', '942200-1', '942200-2']
+    rulesets = list(util.iter_rulesets(str(tmp_path), False,
+                                       name='9421*.yaml', enabled_only=True))
+    assert [test.test_title for test in rulesets[0].tests] == ['942100-1']
+    rulesets = list(util.iter_rulesets(str(tmp_path), False, title='-2$'))
+    assert len(rulesets) == 2
+    # Tests keep their index in the file, and so their stage ids
+    assert rulesets[0].tests[0].test_index == 1
+    assert rulesets[0].tests[0].stages[0].id.endswith('-1-0')
+    assert len(list(util.iter_rulesets(str(tmp_path), False))) == 3
@@ -1,15 +1,59 @@
 import argparse
-from ftw import util, testrunner
+import os
+import time
+from ftw import journal, util, testrunner
 
 
-def build_journal(journal_file, ruledir, ruledir_recurse, tablename):
-    util.instantiate_database(journal_file)
-    rulesets = util.get_rulesets(ruledir, ruledir_recurse)
-    for rule in rulesets:
-        for test in rule.tests:
-            runner = testrunner.TestRunner()
-            runner.run_test_build_journal(test.ruleset_meta['name'],
-                                          test, journal_file, tablename)
+def build_journal(journal_file, ruledir, ruledir_recurse, tablename,
+                  cache_dir=None, journal_version=journal.JOURNAL_VERSION,
+                  jobs=1, resume=False, progress_interval=10):
+    journaled = set()
+    if resume and os.path.exists(journal_file):
+        journaled = journal.get_journaled_stages(journal_file, tablename)
+    elif journal_version == 1:
+        util.instantiate_database(journal_file)
+    else:
+        journal.instantiate_journal(journal_file, tablename)
+    rulesets = util.get_rulesets(ruledir, ruledir_recurse,
+                                 cache_dir=cache_dir)
+    tests = [test for rule in rulesets for test in rule.tests]
+    runner = testrunner.TestRunner()
+    with journal.JournalWriter(journal_file, tablename) as writer:
+
+        def build_test(test):
+            """
+            Journal the stages of test not in the journal yet, returning
+            False if there were none
+            """
+            rule_id = test.ruleset_meta['name']
+            skip_stages = set(
+                i for i in range(len(test.stages))
+                if (str(rule_id), str(test.test_title), i) in journaled)
+            if len(skip_stages) == len(test.stages):
+                return False
+            runner.run_test_build_journal(rule_id, test, journal_file,
+                                          tablename, journal_writer=writer,
+                                          skip_stages=skip_stages)
+            return True
+
+        start = last_report = time.monotonic()
+        built = skipped = 0
+        for ran in runner.run_concurrently(build_test, tests, jobs):
+            if ran:
+                built += 1
+            else:
+                skipped += 1
+            now = time.monotonic()
+            if now - last_report >= progress_interval:
+                last_report = now
+                report_progress(built, skipped, len(tests), now - start)
+        report_progress(built, skipped, len(tests), time.monotonic() - start)
+
+
+def report_progress(built, skipped, total, elapsed):
+    rate = built / elapsed if elapsed > 0 else 0.0
+    print('Journaled %d/%d tests (%d already journaled) in %.1fs, '
+          '%.1f tests/s' % (built + skipped, total, skipped, elapsed, rate))
 
 
 def main():
@@ -22,12 +66,26 @@ def main():
                         help='Recursively search rule directories')
     parser.add_argument('--tablename', default='ftw',
                         help='Table name in journal sqlite database')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory caching parsed rule files')
+    parser.add_argument('--journal-version', type=int, choices=[1, 2],
+                        default=journal.JOURNAL_VERSION,
+                        help='Journal format to write')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of tests to run concurrently')
+    parser.add_argument('--resume', action='store_true',
+                        help='Keep an existing journal and skip the stages '
+                        'already in it')
+    parser.add_argument('--progress-interval', type=float, default=10,
+                        help='Seconds between progress reports')
     args = parser.parse_args()
     journal_file = args.journal
     ruledir = args.ruledir
     ruledir_recurse = args.ruledir_recurse
     tablename = args.tablename
-    build_journal(journal_file, ruledir, ruledir_recurse, tablename)
+    build_journal(journal_file, ruledir, ruledir_recurse, tablename,
+                  args.cache_dir, args.journal_version, args.jobs,
+                  args.resume, args.progress_interval)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,21 @@
+import argparse
+from ftw import journal
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert an FTW Journal database to the current format')
+    parser.add_argument('--journal', default='journal.sqlite',
+                        help='Path to journal default')
+    parser.add_argument('--tablename', default='ftw',
+                        help='Table name in journal sqlite database')
+    args = parser.parse_args()
+    if journal.migrate(args.journal, args.tablename):
+        print('Migrated %s to version %d' %
+              (args.journal, journal.JOURNAL_VERSION))
+    else:
+        print('%s is already up to date' % args.journal)
+
+
+if __name__ == '__main__':
+    main()